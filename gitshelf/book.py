@@ -15,14 +15,29 @@
 # under the License.
 import logging
 import os
-import errno
-from sh import git
+import fnmatch
+import hashlib
+import json
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from sh import git, ErrorReturnCode, TimeoutException
+from gitshelf import links
+from gitshelf.engine import imap, remaining
+from gitshelf.exceptions import BookTimeout, GitFailed
+from gitshelf.gitdir import GitDir, ABBREV_SHA1_RE, SHA1_RE
+from gitshelf.result import BookResult
+from gitshelf.timing import operation, timed
 from gitshelf.utils import Url
 
 LOG = logging.getLogger(__name__)
 
+# diffs are read from git in chunks of this size
+DIFF_CHUNK = 64 * 1024
 
-class Book:
+
+class Book(object):
     """ Object to represent a book - repo on disk
 
         Books can be one of 2 types:
@@ -37,78 +52,211 @@ class Book:
             skiprepourlcheck -- flag to skip that the git url matches the definition during status checks
             fakeroot -- a gitshelf may specify absolute paths, setting fakeroot allows you to make an
                         absolute path relative to the passed path
+            depth -- clone with history truncated to this many commits
+            filter -- partial clone filter spec, e.g. blob:none
+            singlebranch -- clone only the history of the pinned branch/tag
+            reference -- path to a local repo to borrow objects from when cloning
+            dissociate -- copy borrowed objects into the book once cloned, so it no longer
+                          depends on the reference repo
+            cache -- MirrorCache to clone the book through, rather than straight from git
+            ssh -- SshMultiplexer sharing connections to the book's host, if it's reached over ssh
+            tags -- list of labels, or a single label, used to select books with --only/--exclude
+            state -- StateFile of the last known status of each book, status() skips books
+                     whose fingerprint hasn't changed since
 
     """
 
+    # books are created by the thousand for large shelves, so they're kept
+    # small, the resolved path & link target are only worked out when used
+    __slots__ = ('book', 'git', 'branch', 'skiprepourlcheck', 'fakeroot', 'depth', 'filter',
+                 'singlebranch', 'reference', 'dissociate', 'cache', 'ssh', 'tags', 'state',
+                 '_link', '_path', '_target')
+
     def __init__(self,
                  book,
                  git=None,
                  branch='master',
                  link=None,
                  skiprepourlcheck=False,
-                 fakeroot=None):
+                 fakeroot=None,
+                 depth=None,
+                 filter=None,
+                 singlebranch=False,
+                 reference=None,
+                 dissociate=False,
+                 cache=None,
+                 ssh=None,
+                 tags=None,
+                 state=None):
         """Instantiate a book object"""
-        self.path = book
+        if (git is None) and (link is None):
+            raise StandardError("Book is neither git or link!")
+
+        self.book = book
         self.git = git
-        self.link = link
         self.branch = branch
         self.skiprepourlcheck = skiprepourlcheck
         self.fakeroot = fakeroot
-
-        if (self.git is None) and (self.link is None):
-            raise StandardError("Book is neither git or link!")
-
+        self.depth = depth
+        self.filter = filter
+        self.singlebranch = singlebranch
+        self.reference = reference
+        self.dissociate = dissociate
+        self.cache = cache
+        self.ssh = ssh
+        self.tags = (tags,) if isinstance(tags, basestring) else tuple(tags or ())
+        self.state = state
+        self._link = link
+        self._path = None
+        self._target = None
+
+    @classmethod
+    def from_config(cls, books, fakeroot=None, **defaults):
+        """Build a Book from each dict of book settings in a parsed gitshelf.yml
+
+        defaults are used for any setting a book doesn't set itself, None
+        values are ignored, fakeroot applies to every book.  The dicts are
+        left as they are.
+        """
+        defaults = dict((key, value) for key, value in defaults.items() if value is not None)
+        result = []
+        for settings in books:
+            kwargs = dict(defaults)
+            kwargs.update(settings)
+            kwargs['fakeroot'] = fakeroot
+            # the settings match the named parameters to the Book class
+            result.append(cls(**kwargs))
+        return result
+
+    def __repr__(self):
+        return '<Book {0}>'.format(self.book)
+
+    @property
+    def path(self):
+        """Where the book is on disk, absolute paths are moved under fakeroot"""
+        if self._path is None:
+            self._path = self._resolve_path()
+        return self._path
+
+    @property
+    def link(self):
+        """The link target, None for a git book
+
+        With a fakeroot, absolute targets are moved under it & made relative
+        to the link's parent, so the shelf still works if it's relocated.
+        """
+        if self._link is None:
+            return None
+        if self._target is None:
+            self._target = self._resolve_link()
+        return self._target
+
+    def _resolve_path(self):
         # Only apply fakeroot to non-relative paths
-        if self.fakeroot is not None and os.path.isabs(self.path):
-            LOG.debug('fakepath set, prepending {0} to {1}'.format(
-                self.fakeroot, self.path))
-            # need to strip any leading os.sep
-            book_path = os.path.join(self.fakeroot, self.path.lstrip(os.sep))
-            self.path = book_path
-            LOG.debug('book.path is now {0}'.format(self.path))
-
-        # Update links with absolute targets to be relative so they work with
-        # fakeroot
-        if self.fakeroot is not None and self.link and os.path.isabs(self.link):
-            # Update the link target to, which also means that
-            # link targets must now be relative to handle relocating a
-            # tarball of the gitshelf.  This is all getting a little
-            # complicated.
-            link_path = os.path.join(self.fakeroot, self.link.lstrip(os.sep))
-            self.link = link_path
-            LOG.debug('After applying fakeroot ({0}) to {1}\'s target, '
-                      'book.link is now {2}'.format(self.fakeroot, self.path, self.link))
-
-            # map target to a relative path, relative to self.path's parent
-            book_parent = os.path.dirname(self.path)
-            link_relative = os.path.relpath(self.link, book_parent)
-            LOG.debug('book.link target ({0}), relative to {1} is {2}'.format(self.link,
-                                                                              book_parent,
-                                                                              link_relative))
-            self.link = link_relative
+        if self.fakeroot is None or not os.path.isabs(self.book):
+            return self.book
+
+        # need to strip any leading os.sep
+        path = os.path.join(self.fakeroot, self.book.lstrip(os.sep))
+        LOG.debug('fakeroot set, book %s is at %s', self.book, path)
+        return path
+
+    def _resolve_link(self):
+        if self.fakeroot is None or not os.path.isabs(self._link):
+            return self._link
+
+        # Update the link target, which also means that link targets must
+        # now be relative to handle relocating a tarball of the gitshelf.
+        link_path = os.path.join(self.fakeroot, self._link.lstrip(os.sep))
+
+        # map target to a relative path, relative to self.path's parent
+        book_parent = os.path.dirname(self.path)
+        link_relative = os.path.relpath(link_path, book_parent)
+        LOG.debug('After applying fakeroot (%s) to %s\'s target, book.link is %s, relative to %s is %s',
+                  self.fakeroot, self.path, link_path, book_parent, link_relative)
+        return link_relative
+
+    def _git(self, *args, **kwargs):
+        """Run git against this book's working tree
+
+        The working directory is handed to the git process rather than
+        changed for the whole process, so books can be worked on from
+        several threads at once.  git is killed if it runs past the time
+        the engine allows for the book.
+        """
+        kwargs.setdefault('_cwd', self.path)
+        timeout = remaining()
+        if timeout is not None:
+            kwargs.setdefault('_timeout', timeout)
+        try:
+            with timed(args[0]):
+                return git(*args, **kwargs)
+        except TimeoutException:
+            raise BookTimeout("git {0} timed out in book {1}".format(args[0], self.path))
+
+    @property
+    def kind(self):
+        """'git' or 'link', None if the book is neither or both"""
+        if self.git and self.link is None:
+            return 'git'
+        if self.link and self.git is None:
+            return 'link'
+        return None
 
     def create(self):
-        if self.git and self.link is None:
-            self._create_git()
-        elif self.link and self.git is None:
-            self._create_link()
+        """Create the book, or put it right if it exists
+
+        Returns a BookResult, whose state is created, switched (to the
+        pinned branch), relinked or ok if there was nothing to do.
+        """
+        if self.kind == 'git':
+            state = self._create_git()
+            return BookResult(self.path, kind='git', state=state, sha1=self._head())
+        elif self.kind == 'link':
+            return BookResult(self.path, kind='link', state=self._create_link(), target=self.link)
+        LOG.error('Unknown book type: {0}'.format(self.path))
+        return BookResult(self.path, state='unknown')
+
+    def plan(self):
+        """Work out what create() would do, from the book on disk alone
+
+        Returns an (action, reason) tuple, action is one of clone, checkout,
+        link, relink, noop or unknown.  Nothing is fetched or changed.
+        """
+        if self.kind == 'git':
+            if not os.path.exists(self.path):
+                return ('clone', "doesn't exist")
+            if not self._check_branch():
+                return ('checkout', 'not at {0}'.format(self.branch))
+            return ('noop', 'at {0}'.format(self.branch))
+        elif self.kind == 'link':
+            if not os.path.islink(self.path):
+                return ('link', "doesn't exist")
+            if not self._check_link():
+                return ('relink', 'points to {0}'.format(os.readlink(self.path)))
+            return ('noop', 'points to {0}'.format(self.link))
+        return ('unknown', 'neither a git repo nor a link')
 
     def _create_git(self):
-        """create a book from a git repo"""
+        """create a book from a git repo, returns what was done"""
 
+        state = 'ok'
         if not os.path.exists(self.path):
+            state = 'created'
             LOG.info(("Creating book {0} from {1}, branch: {2}" +
                      "").format(self.path, self.git, self.branch))
-            git.clone(self.git, self.path)
+            with self._remote():
+                source = self._fetch_source()
+                self._git('clone', self._clone_args(), source, self.path, _cwd=None)
+            if source != self.git:
+                # point the book back at the real remote, not the cache
+                self._git('remote', 'set-url', 'origin', self.git)
         else:
             LOG.info("Book {0} already exists".format(self.path))
 
-        cwd = os.getcwd()
-        os.chdir(self.path)
-
         if self.skiprepourlcheck:
             remote_match_found = False
-            for remote in git("remote", "-v"):
+            for remote in self._git("remote", "-v"):
                 remote_parts = remote.split()
 
                 if Url(remote_parts[1]) == Url(self.git):
@@ -120,61 +268,157 @@ class Book:
                 LOG.error('ERROR: {0} wasn\'t found in the list of remotes for {1}'.format(self.git, self.path))
 
         if not self._check_branch():
+            # only go to the network if the pinned ref isn't here already,
+            # e.g. a sha1 outside a shallow clone's history
+            if self._has_ref():
+                LOG.debug("Book {0} already has {1}, skipping fetch".format(self.path, self.branch))
+            else:
+                self._fetch_ref()
             LOG.info("Switching {0} to branch {1}".format(self.path,
                                                           self.branch))
-            git.fetch
-            git.checkout(self.branch)
-
-        os.chdir(cwd)
+            self._checkout()
+            if state == 'ok':
+                state = 'switched'
+
+        return state
+
+    def _checkout(self):
+        """check out the pinned branch/tag/sha1"""
+        gitdir = GitDir(self.path)
+        remote_branch = 'origin/{0}'.format(self.branch)
+        if gitdir.lookup(self.branch) is None and gitdir.lookup(remote_branch) is not None:
+            # git only guesses a branch from origin/<branch> if it's covered by
+            # the fetch refspec, which single branch clones narrow down
+            self._git('checkout', '-b', self.branch, remote_branch)
+        else:
+            self._git('checkout', self.branch)
 
-    def _create_link(self):
-        """create a book from a link to somewhere else"""
-
-        cwd = os.getcwd()
-        parent = os.path.dirname(self.path.rstrip(os.sep))
-
-        if not os.path.islink(self.path):
-            LOG.info("Creating book {0} via a link to {1}".format(self.path, self.link))
-            # create the parent directory, if required
-            self._mkdir_p(os.path.dirname(self.path.rstrip(os.sep)))
-            # move to the parent so that creating relative sym-links make sense
-            os.chdir(parent)
-            # create the symlink
-            os.symlink(self.link, os.path.basename(self.path))
+    @contextmanager
+    def _remote(self):
+        """hold a slot on the book's remote host while talking to it"""
+        if self.ssh is None:
+            yield
         else:
-            if not self._check_link():
-                LOG.info("Correcting book {0} to {1}".format(self.path, self.link))
-                os.remove(self.path)
-                # move to the parent so that creating relative sym-links make sense
-                os.chdir(parent)
-                # re-create the symlink
-                os.symlink(self.link, os.path.basename(self.path))
-            else:
-                LOG.info("Book {0} already exists, target: {1}".format(self.path, os.readlink(self.path)))
-        os.chdir(cwd)
+            with self.ssh.slot(self.git):
+                yield
+
+    def _fetch_source(self):
+        """where to clone/fetch the book from, the mirror cache if there is one"""
+        if self.cache is None:
+            return self.git
+
+        source = self.cache.ensure(self.git)
+        if self.depth or self.filter:
+            # git ignores --depth & --filter for local paths
+            source = 'file://{0}'.format(os.path.abspath(source))
+        return source
+
+    def _has_ref(self):
+        """Check if the pinned branch/tag/sha1 can be checked out without fetching"""
+        gitdir = GitDir(self.path)
+        # a local ref, or a remote branch `git checkout` will track
+        if gitdir.lookup(self.branch) or gitdir.lookup('origin/{0}'.format(self.branch)):
+            return True
 
-    def _mkdir_p(self, path):
-        if path == "":
-            return
+        if SHA1_RE.match(self.branch) and gitdir.has_loose_object(self.branch):
+            return True
 
-        try:
-            os.makedirs(path)
-        except OSError as exc:  # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(path):
-                pass
-            else:
-                raise
+        if SHA1_RE.match(self.branch) or ABBREV_SHA1_RE.match(self.branch):
+            # the commit may be in a pack, let git look it up
+            try:
+                self._git('cat-file', '-e', '{0}^{{commit}}'.format(self.branch))
+                return True
+            except ErrorReturnCode:
+                return False
+
+        return False
+
+    def _fetch_ref(self):
+        """Fetch just the pinned branch/tag/sha1"""
+        with self._remote():
+            source = 'origin' if self.cache is None else self._fetch_source()
+        depth = ['--depth={0}'.format(self.depth)] if self.depth else []
+
+        if SHA1_RE.match(self.branch):
+            attempts = [[self.branch]]
+        elif ABBREV_SHA1_RE.match(self.branch):
+            # abbreviated sha1s can't be fetched by name
+            attempts = []
+        else:
+            # we can't tell a branch from a tag without asking the remote,
+            # so try each, a missing ref fails before anything is fetched
+            attempts = [['+refs/heads/{0}:refs/remotes/origin/{0}'.format(self.branch)],
+                        ['+refs/tags/{0}:refs/tags/{0}'.format(self.branch)]]
+
+        # failing that, everything, as a plain `git fetch` would
+        attempts.append(['+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*'])
+
+        for refspecs in attempts:
+            LOG.info("Fetching {0} into book {1}".format(' '.join(refspecs), self.path))
+            try:
+                with self._remote():
+                    self._git('fetch', '--quiet', depth, source, refspecs)
+                return
+            except ErrorReturnCode as e:
+                if refspecs is attempts[-1]:
+                    raise
+                LOG.debug("Fetch of {0} into {1} failed: {2}".format(refspecs, self.path, e.stderr.strip()))
+
+    def _clone_args(self):
+        """build the options for cloning this book"""
+        args = []
+        if self.depth:
+            args.append('--depth={0}'.format(self.depth))
+        if self.filter:
+            args.append('--filter={0}'.format(self.filter))
+        if self.singlebranch:
+            args.append('--single-branch')
+        pinned_sha1 = SHA1_RE.match(self.branch) or ABBREV_SHA1_RE.match(self.branch)
+        if (self.depth or self.singlebranch) and not pinned_sha1:
+            # start from the pinned branch/tag, so that it's the one history
+            # that is fetched
+            args.append('--branch={0}'.format(self.branch))
+        if self.reference:
+            args.append('--reference-if-able={0}'.format(self.reference))
+        if self.dissociate:
+            args.append('--dissociate')
+        return args
+
+    def _create_link(self):
+        """create a book from a link to somewhere else, returns what was done"""
+        state = links.ensure(self.path, self.link)
+        if state == 'ok':
+            LOG.info("Book {0} already exists, target: {1}".format(self.path, self.link))
+        return state
 
     def _check_branch(self):
-        """Check that the current working directory is at the given branch/sha1"""
+        """Check that the book is at the given branch/sha1
+
+        HEAD and the pinned ref are read straight from the book's .git
+        directory, git is only run when the files can't give a definite
+        answer (abbreviated sha1s, loose annotated tags, ...).
+        """
+
+        gitdir = GitDir(self.path)
+        symref, sha1 = gitdir.head()
+        if symref is not None and symref.startswith('refs/heads/'):
+            cb = symref[len('refs/heads/'):]
+        else:
+            cb = symref or 'HEAD'
+
+        match = None
+        if sha1 is not None:
+            match = self._match_branch(gitdir, symref, sha1)
+
+        if match is None:
+            LOG.debug("Book {0}: can't resolve {1} from .git, asking git".format(self.path, self.branch))
+            sha1, match = self._match_branch_git()
 
-        cb = git('describe', '--all', '--contains', '--abbrev=4', 'HEAD').rstrip('\r\n')
-        sha1 = git('rev-parse', 'HEAD').rstrip('\r\n')
         LOG.debug("Book {0} should be at {1}".format(self.path, self.branch))
         LOG.debug("Book {0}'s current branch is {1}".format(self.path, cb))
         LOG.debug("Book {0}'s current sha1 is {1}".format(self.path, sha1))
 
-        if ((cb == self.branch) or (sha1 == self.branch)):
+        if match:
             return True
         else:
             LOG.warn("WARNING {0} is at branch:{1} (sha1: {2}), not {3}".format(self.path,
@@ -183,6 +427,45 @@ class Book:
                                                                                 self.branch))
             return False
 
+    def _match_branch(self, gitdir, symref, sha1):
+        """Compare HEAD with the pinned branch/sha1/tag using only .git
+
+        Returns True or False, or None if git needs to be asked.
+        """
+        if self.branch == sha1:
+            return True
+
+        if symref is not None and self.branch in (symref, symref[len('refs/heads/'):]):
+            return True
+
+        ref = gitdir.lookup(self.branch)
+        if ref is None:
+            # no such ref, but it could still be an abbreviated sha1
+            if ABBREV_SHA1_RE.match(self.branch):
+                return None
+            return False
+
+        refname, ref_sha1, commit = ref
+        if commit is not None:
+            return commit == sha1
+        if ref_sha1 == sha1:
+            return True
+
+        # a loose tag that may be annotated, git has to peel it
+        return None
+
+    def _match_branch_git(self):
+        """Compare HEAD with the pinned branch/sha1/tag using a single git call
+
+        Returns a (sha1, match) tuple.
+        """
+        try:
+            shas = self._git('rev-parse', 'HEAD', '{0}^{{commit}}'.format(self.branch)).split()
+        except ErrorReturnCode:
+            # the pinned ref doesn't exist in this repo
+            return (self._git('rev-parse', 'HEAD').rstrip('\r\n'), False)
+        return (shas[0], shas[0] == shas[1])
+
     def _check_link(self):
         # check the link points to the correct location
         link_target = os.readlink(self.path)
@@ -193,150 +476,419 @@ class Book:
         else:
             return False
 
+    def fingerprint(self):
+        """Summarise the files git keeps that the book's status depends on
+
+        Returns a digest that changes whenever HEAD (or the ref it points
+        at), the index, the fetched refs or the link target does, or None
+        if the book doesn't exist.  The working tree isn't looked at, as
+        walking it costs more than the `git status` this saves, so a file
+        edited in place is only noticed once git next updates the index
+        (e.g. `git add`, `git status` or a commit).
+        """
+        digest = hashlib.sha1(json.dumps([self.git, self.branch, self.link]))
+
+        if self.link is not None:
+            try:
+                digest.update(os.readlink(self.path))
+            except OSError:
+                return None
+            return digest.hexdigest()
+
+        gitdir = GitDir(self.path)
+        if not gitdir.exists():
+            return None
+
+        # HEAD (and the ref it points at), the index, and the refs a fetch
+        # updates, which the ahead/behind counts depend on
+        digest.update(repr(gitdir.head()))
+        for base, name in ((gitdir.path, 'HEAD'), (gitdir.path, 'index'),
+                           (gitdir.path, 'FETCH_HEAD'), (gitdir.common, 'packed-refs')):
+            digest.update(repr(_stat(os.path.join(base, name))))
+
+        return digest.hexdigest()
+
     def status(self):
+        """Check that the book exists, is at the right branch/sha1 & is clean
+
+        Returns a BookResult, with the branch, tracking & file counts from
+        git status in its details.  With a state file, the last result is
+        returned without running git if the book hasn't changed since.
+        """
+        if self.state is None:
+            return self._status()
+
+        fingerprint = self.fingerprint()
+        if fingerprint is not None:
+            result = self.state.get(self.path, fingerprint)
+            if result is not None:
+                if result.state == 'ok':
+                    LOG.info("# book {0} OK, unchanged".format(self.path))
+                else:
+                    LOG.error("ERROR book {0} is {1}, unchanged".format(self.path, result.state))
+                return result
+
+        result = self._status()
+        if fingerprint is not None and result.state != 'unknown':
+            self.state.put(self.path, fingerprint, result)
+        return result
+
+    def _status(self):
         if self.git and self.link is None:
+            details = {'git': self.git, 'branch': self.branch}
             # git repo, check it exists & isn't dirty
             if not os.path.exists(self.path):
                 LOG.info("ERROR book {0} from {1} doesn't exist.".format(
                     self.path,
                     self.git))
+                return BookResult(self.path, kind='git', state='missing', **details)
             else:
-                # chdir to the book & run `git status`
-                cwd = os.getcwd()
-                os.chdir(self.path)
-                if self._check_branch():
-                    git_status = git.status()
-                    if "nothing to commit, working directory clean" in git_status:
-                        LOG.info("# book {0} OK".format(self.path))
-                    else:
-                        LOG.info("# book {0}".format(self.path))
-                        LOG.info(git_status)
-                os.chdir(cwd)
+                on_branch = self._check_branch()
+                # one `git status` gives us the branch, tracking & file states
+                git_status, changes = _parse_porcelain_v2(self._git('status', '--porcelain=v2', '--branch'))
+                sha1 = git_status.pop('sha1')
+                details.update(git_status)
+
+                dirty = (git_status['staged'] + git_status['modified'] +
+                         git_status['unmerged'] + git_status['untracked']) > 0
+                if not on_branch:
+                    state = 'wrong-branch'
+                elif dirty:
+                    state = 'dirty'
+                else:
+                    state = 'ok'
+                    LOG.info("# book {0} OK".format(self.path))
+
+                if dirty:
+                    LOG.info("# book {0}: {1} staged, {2} modified, {3} unmerged, {4} untracked".format(
+                        self.path,
+                        git_status['staged'],
+                        git_status['modified'],
+                        git_status['unmerged'],
+                        git_status['untracked']))
+                    for change in changes:
+                        LOG.info(change)
+
+                return BookResult(self.path, kind='git', state=state, sha1=sha1, **details)
 
         elif self.link and self.git is None:
             # check the link points to the correct location
-            if self._check_link():
+            if not os.path.islink(self.path):
+                LOG.error("ERROR book {0} doesn't exist, it should point to {1}".format(self.path, self.link))
+                return BookResult(self.path, kind='link', state='missing', link=self.link)
+            elif self._check_link():
                 LOG.info('# book {0} correctly points to {1}'.format(self.path, self.link))
+                return BookResult(self.path, kind='link', state='ok', link=self.link, target=self.link)
             else:
                 link_target = os.readlink(self.path)
                 LOG.error('ERROR: {0} should point to {1}, it points to {2}'.format(self.path, self.link, link_target))
+                return BookResult(self.path, kind='link', state='wrong-link', link=self.link, target=link_target)
 
         else:
             LOG.error('Unknown book type: {0}'.format(self.path))
+            return BookResult(self.path, state='unknown')
+
+    def diff(self, mode='patch', output=None, max_bytes=None):
+        """Show the uncommitted changes in the book
 
-    def diff(self):
+        Returns a BookResult, whose state is clean or changed for a repo.
+
+        Keyword arguments:
+            mode -- patch for the full diff, stat or name-only for a summary
+                    of the changed files, quiet for no output at all
+            output -- file to write the diff to, as it's produced, by default
+                      it's logged
+            max_bytes -- stop writing the diff after this many bytes, git is
+                         stopped rather than the rest being read
+        """
         if self.git and self.link is None:
             # git repo, check it exists & isn't dirty
             if not os.path.exists(self.path):
                 LOG.info("ERROR book {0} from {1} doesn't exist.".format(
                     self.path,
                     self.git))
+                return BookResult(self.path, kind='git', state='missing')
+            elif mode == 'quiet':
+                # --quiet exits 1 when there are changes, without working them out
+                changed = self._git('diff', quiet=True, _ok_code=[0, 1]).exit_code == 1
+                return BookResult(self.path, kind='git', state='changed' if changed else 'clean',
+                                  sha1=self._head())
             else:
-                # chdir to the book & run `git status`
-                cwd = os.getcwd()
-                os.chdir(self.path)
+                # run `git diff` in the book
                 LOG.info("# book {0}".format(self.path))
-                git_diff = git.diff(exit_code=True)
-                if git_diff:
-                    LOG.info("# book {0} had changes:".format(self.path))
-                    LOG.info(git_diff)
+                written, truncated = self._diff_output(mode, output, max_bytes)
+                if written:
+                    LOG.info("# book {0} had changes".format(self.path))
+                    state = 'changed'
                 else:
                     LOG.info("# book {0} is clean".format(self.path))
-                os.chdir(cwd)
+                    state = 'clean'
+                return BookResult(self.path, kind='git', state=state, sha1=self._head(),
+                                  bytes=written, truncated=truncated)
         elif self.link and self.git is None:
             # check the link points to the correct location
+            if not os.path.islink(self.path):
+                LOG.error("ERROR book {0} doesn't exist, it should point to {1}".format(self.path, self.link))
+                return BookResult(self.path, kind='link', state='missing', target=None)
             link_target = os.readlink(self.path)
             LOG.debug('book: {0} should point to {1}, it points to {2}'.format(self.path, self.link, link_target))
             if link_target == self.link:
                 LOG.info('# book {0} correctly points to {1}'.format(self.path, self.link))
+                return BookResult(self.path, kind='link', state='ok', target=link_target)
             else:
-                LOG.error('{0} should point to {1}, it points to {2}'.format(self.path, self.link, self.link))
+                LOG.error('{0} should point to {1}, it points to {2}'.format(self.path, self.link, link_target))
+                return BookResult(self.path, kind='link', state='wrong-link', target=link_target)
         else:
             LOG.error('Unknown book type: {0}'.format(self.path))
-
-    def pull(self):
-        if self.git and self.link is None:
-            # git repo, check it exists & isn't dirty
-            if not os.path.exists(self.path):
-                LOG.info("ERROR book {0} from {1} doesn't exist.".format(
-                    self.path,
-                    self.git))
+            return BookResult(self.path, state='unknown')
+
+    def _diff_output(self, mode, output=None, max_bytes=None):
+        """Stream `git diff` to output, returns (bytes written, truncated)
+
+        The diff is written as git produces it, a DIFF_CHUNK at a time, so
+        only a chunk of it is held in memory, however large it is.  git's
+        output is read straight from a pipe, rather than through sh, whose
+        output callbacks add a fixed delay to every command.
+        """
+        written = 0
+        truncated = False
+
+        def write(data):
+            if output is None:
+                LOG.info(data.rstrip('\n'))
             else:
-                # chdir to the book & run `git status`
-                cwd = os.getcwd()
-                os.chdir(self.path)
-                LOG.info("# book {0}".format(self.path))
-                git_diff = git.diff()
-                if git_diff:
-                    LOG.info("# book {0} had changes:".format(self.path))
-                    LOG.info(git_diff)
-                else:
-                    LOG.info("# book {0} is clean".format(self.path))
-                os.chdir(cwd)
-        elif self.link and self.git is None:
-            # check the link points to the correct location
-            link_target = os.readlink(self.path)
-            LOG.debug('book: {0} should point to {1}, it points to {2}'.format(self.path, self.link, link_target))
-            if link_target == self.link:
-                LOG.info('# book {0} correctly points to {1}'.format(self.path, self.link))
+                output.write(data)
+
+        args = {'stat': ['--stat'], 'name-only': ['--name-only']}.get(mode, [])
+        timeout = remaining()
+        timed_out = threading.Event()
+
+        with timed('diff'), open(os.devnull) as devnull, tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(['git', 'diff'] + args, cwd=self.path,
+                                       stdin=devnull, stdout=subprocess.PIPE, stderr=errors)
+            timer = None
+            if timeout is not None:
+                def kill():
+                    timed_out.set()
+                    process.kill()
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+            try:
+                while True:
+                    chunk = process.stdout.read(DIFF_CHUNK)
+                    if not chunk:
+                        break
+                    if max_bytes is not None and written + len(chunk) > max_bytes:
+                        write(chunk[:max_bytes - written])
+                        written = max_bytes
+                        truncated = True
+                        # no need for the rest of the diff, stop git producing it
+                        process.terminate()
+                        break
+                    write(chunk)
+                    written += len(chunk)
+            finally:
+                process.stdout.close()
+                exit_code = process.wait()
+                if timer is not None:
+                    timer.cancel()
+
+            if timed_out.is_set():
+                raise BookTimeout("git diff timed out in book {0}".format(self.path))
+            if exit_code != 0 and not truncated:
+                errors.seek(0)
+                raise GitFailed('diff', exit_code, errors.read().strip())
+
+        if truncated:
+            write("\n# ... diff of book {0} truncated at {1} bytes\n".format(self.path, max_bytes))
+        return written, truncated
+
+    def fetch(self, source=None):
+        """Fetch the book's remote branches & tags, without changing the working tree
+
+        source is the path of another book with the same remote, fetched
+        already, to fetch from instead of the network.
+        """
+        if self.git is None or not os.path.exists(self.path):
+            return
+
+        if source is not None:
+            LOG.info("Fetching book {0} from {1}".format(self.path, source))
+            self._git('fetch', '--quiet', os.path.abspath(source),
+                      '+refs/remotes/origin/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*')
+            return
+
+        LOG.info("Fetching book {0}".format(self.path))
+        with self._remote():
+            if self.cache is None:
+                # origin's own refspecs, narrowed for single branch clones
+                self._git('fetch', '--quiet', 'origin')
             else:
-                LOG.error('{0} should point to {1}, it points to {2}'.format(self.path, self.link, self.link))
+                self._git('fetch', '--quiet', self._fetch_source(),
+                          '+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*')
+
+    def update(self):
+        """Bring the book up to date with what's been fetched
+
+        A book pinned to a branch is fast-forwarded to the remote branch, a
+        book pinned to a tag or sha1 is checked out at it, if it isn't
+        already.  Returns a BookResult, whose state is moved or ok, with
+        the sha1s of HEAD before & after as its from & to details.
+        """
+        if self.git is None:
+            return BookResult(self.path, kind=self.kind, state='ok')
+        if not os.path.exists(self.path):
+            LOG.error("ERROR book {0} from {1} doesn't exist.".format(self.path, self.git))
+            return BookResult(self.path, kind='git', state='missing')
+
+        old = self._head()
+        gitdir = GitDir(self.path)
+        remote_branch = 'origin/{0}'.format(self.branch)
+        if gitdir.lookup(remote_branch) is not None:
+            if gitdir.head()[0] != 'refs/heads/{0}'.format(self.branch):
+                self._checkout()
+            self._git('merge', '--ff-only', '--quiet', remote_branch)
+        elif not self._check_branch():
+            if not self._has_ref():
+                self._fetch_ref()
+            self._checkout()
+
+        new = self._head()
+        if old != new:
+            LOG.info("# book {0} moved from {1} to {2}".format(self.path, old, new))
         else:
-            LOG.error('Unknown book type: {0}'.format(self.path))
+            LOG.info("# book {0} is up to date".format(self.path))
+        return BookResult(self.path, kind='git', state='moved' if old != new else 'ok', sha1=new,
+                          **{'from': old, 'to': new})
+
+    def pull(self):
+        """fetch & update a single book"""
+        self.fetch()
+        return self.update()
+
+    def _head(self):
+        """sha1 of HEAD"""
+        sha1 = GitDir(self.path).head()[1]
+        if sha1 is None:
+            sha1 = str(self._git('rev-parse', 'HEAD')).strip()
+        return sha1
+
+    @staticmethod
+    def discover(rootdir='.', usebranch=False, exclude=None, maxdepth=None, jobs=1):
+        """discover all the git repo's & symlinks under this directory
+
+        Books are yielded in path order as soon as each one is ready, the
+        details of up to `jobs` repos are collected at once.
+        """
+
+        def _discover_book(found):
+            kind, path = found
+            full_path = os.path.join(rootdir, path)
+            if kind == 'link':
+                return Book(book=path, link=os.readlink(full_path))
+
+            try:
+                with operation(path, 'discover'):
+                    sha1 = Book._discover_sha1(full_path)
+                    remotes = Book._discover_remotes(full_path)
+                    branch = Book._discover_branch(full_path) if usebranch else None
+            except ErrorReturnCode as e:
+                LOG.warn("WARNING skipping git repo {0}, git failed: {1}".format(path, e.stderr.strip()))
+                return None
+
+            LOG.debug("Found a git repo! {0}".format(path))
+            LOG.debug("remotes are {0}".format(remotes))
+            LOG.debug("branch is {0}".format(branch))
+            LOG.debug("sha1 is {0}".format(sha1))
+            if 'origin' not in remotes:
+                LOG.warn("WARNING skipping git repo {0}, it has no origin remote".format(path))
+                return None
+
+            if usebranch:
+                return Book(book=path, git=remotes['origin'], branch=branch)
+            else:
+                return Book(book=path, git=remotes['origin'], branch=sha1)
+
+        found = Book._scan(rootdir, exclude=exclude, maxdepth=maxdepth)
+        for book in imap(_discover_book, found, jobs=jobs):
+            if book is not None:
+                yield book
 
     @staticmethod
-    def discover(rootdir='.', usebranch=False):
-        """discover all the git repo's under this directory"""
-        books = []
-        for root, subFolders, files in os.walk(rootdir):
-            for file in files:
-                this_file = os.path.join(root, file).replace(rootdir + os.sep, '')
-                if this_file.endswith('.git/config') and not this_file.startswith('.git/config'):
-                    repo = os.path.dirname(os.path.dirname(this_file))
-                    branch = (Book._discover_branch(repo))
-                    sha1 = (Book._discover_sha1(repo))
-                    remotes = Book._discover_remotes(repo)
-                    LOG.debug("Found a git repo! {0}".format(repo))
-                    LOG.debug("remotes are {0}".format(remotes))
-                    LOG.debug("branch is {0}".format(branch))
-                    LOG.debug("sha1 is {0}".format(sha1))
-                    if usebranch:
-                        books.append(Book(book=repo, git=remotes['origin'], branch=branch))
-                    else:
-                        books.append(Book(book=repo, git=remotes['origin'], branch=sha1))
-
-                if os.path.islink(this_file):
-                        books.append(Book(book=this_file, link=os.readlink(this_file)))
-        return books
+    def _scan(rootdir='.', exclude=None, maxdepth=None):
+        """Walk rootdir, yielding a (kind, path) tuple for each book found
+
+        kind is 'git' for a repo or 'link' for a symlink, path is relative
+        to rootdir.  Entries are yielded in path order.  A directory
+        containing .git is a repo and is never descended into, so
+        .git/objects and the working trees of repos aren't walked.
+
+        Keyword arguments:
+            exclude -- list of glob patterns, matched against both the name
+                       & relative path of each entry, to skip
+            maxdepth -- how many directory levels below rootdir to look in,
+                        None for no limit
+        """
+        exclude = exclude or []
+
+        def _excluded(name, path):
+            for pattern in exclude:
+                if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+                    return True
+            return False
+
+        def _scan_dir(root, rel_root, depth):
+            try:
+                names = sorted(os.listdir(root))
+            except OSError as e:
+                LOG.warn("WARNING can't list {0}: {1}".format(root, e))
+                return
+
+            for name in names:
+                if name == '.git':
+                    # only possible at the top, rootdir being a repo itself
+                    continue
+                path = os.path.join(rel_root, name)
+                if _excluded(name, path):
+                    continue
+                full_path = os.path.join(root, name)
+                if os.path.islink(full_path):
+                    yield ('link', path)
+                elif os.path.isdir(full_path):
+                    if os.path.exists(os.path.join(full_path, '.git')):
+                        yield ('git', path)
+                    elif maxdepth is None or depth < maxdepth:
+                        for found in _scan_dir(full_path, path, depth + 1):
+                            yield found
+
+        return _scan_dir(rootdir, '', 1)
 
     @staticmethod
     def _discover_branch(path='.'):
         """discover the git branch/sha1 of the given directory"""
-        cwd = os.getcwd()
-        os.chdir(path)
-        cb = git('describe', '--all', '--contains', '--abbrev=4', 'HEAD').rstrip('\r\n')
-        os.chdir(cwd)
+        with timed('describe'):
+            cb = git('describe', '--all', '--contains', '--abbrev=4', 'HEAD', _cwd=path).rstrip('\r\n')
         return cb
 
     @staticmethod
     def _discover_sha1(path='.'):
-        """discover the git branch/sha1 of the given directory"""
-        cwd = os.getcwd()
-        os.chdir(path)
-        sha1 = git('rev-parse', 'HEAD').rstrip('\r\n')
-        os.chdir(cwd)
+        """discover the git sha1 of the given directory"""
+        # read straight from .git where possible, saving a git process
+        sha1 = GitDir(path).head()[1]
+        if sha1 is None:
+            with timed('rev-parse'):
+                sha1 = git('rev-parse', 'HEAD', _cwd=path).rstrip('\r\n')
         return sha1
 
     @staticmethod
     def _discover_remotes(path='.'):
         """discover the remote repos configured for a repo"""
-        cwd = os.getcwd()
-        os.chdir(path)
         remotes = {}
-        for remote_line in git("remote", "-v"):
+        with timed('remote'):
+            remote_lines = git("remote", "-v", _cwd=path)
+        for remote_line in remote_lines:
             r = remote_line.split()[:2]
             remotes[r[0]] = r[1]
-        os.chdir(cwd)
         return remotes
 
     @staticmethod
@@ -347,3 +899,63 @@ class Book:
             return remotes['origin']
         else:
             return remotes[remotes.keys()[0]]
+
+
+def _parse_porcelain_v2(output):
+    """Parse the output of `git status --porcelain=v2 --branch`
+
+    Returns a (status, changes) tuple, status is a dict of the branch
+    headers & counts of changed files, changes is a list of "XY path"
+    lines for the changed files.
+    """
+    status = {'sha1': None,
+              'head': None,
+              'upstream': None,
+              'ahead': 0,
+              'behind': 0,
+              'staged': 0,
+              'modified': 0,
+              'unmerged': 0,
+              'untracked': 0}
+    changes = []
+
+    for line in str(output).splitlines():
+        if line.startswith('# branch.oid '):
+            oid = line[len('# branch.oid '):]
+            status['sha1'] = None if oid == '(initial)' else oid
+        elif line.startswith('# branch.head '):
+            head = line[len('# branch.head '):]
+            status['head'] = None if head == '(detached)' else head
+        elif line.startswith('# branch.upstream '):
+            status['upstream'] = line[len('# branch.upstream '):]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line[len('# branch.ab '):].split()
+            status['ahead'] = abs(int(ahead))
+            status['behind'] = abs(int(behind))
+        elif line.startswith('1 ') or line.startswith('2 '):
+            # ordinary & renamed/copied entries, XY is the index &
+            # worktree state, '.' for unchanged
+            xy = line[2:4]
+            if xy[0] != '.':
+                status['staged'] += 1
+            if xy[1] != '.':
+                status['modified'] += 1
+            fields = 8 if line[0] == '1' else 9
+            changes.append('{0} {1}'.format(xy, line.split(' ', fields)[fields]))
+        elif line.startswith('u '):
+            status['unmerged'] += 1
+            changes.append('{0} {1}'.format(line[2:4], line.split(' ', 10)[10]))
+        elif line.startswith('? '):
+            status['untracked'] += 1
+            changes.append('?? {0}'.format(line[2:]))
+
+    return (status, changes)
+
+
+def _stat(path):
+    """(mtime, size, inode) of path, None if it doesn't exist"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
@@ -0,0 +1,162 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from sh import git
+from gitshelf.timing import timed
+from gitshelf.utils import Url
+
+LOG = logging.getLogger(__name__)
+
+
+class MirrorCache(object):
+    """ A directory of bare mirrors of book remotes, shared between shelves
+
+        Each remote is mirrored once, refreshed with a single fetch the first
+        time it's used in a run, and books are then cloned from the local
+        mirror, which hardlinks the objects rather than copying them.
+
+        Mirrors are locked while they are created or fetched, so several
+        threads or gitshelf processes can share a cache.
+
+        Keyword arguments:
+            path -- directory holding the mirrors, created if needed
+            maxsize -- size in bytes to trim the cache to, evicting the least
+                       recently used mirrors first, None to never evict
+    """
+
+    def __init__(self, path, maxsize=None):
+        self.path = path
+        self.maxsize = maxsize
+        self._used = set()
+        self._used_lock = threading.Lock()
+
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if not (exc.errno == errno.EEXIST and os.path.isdir(self.path)):
+                raise
+
+    @staticmethod
+    def key(url):
+        """Return the name of the mirror for url
+
+        Urls that compare equal share a mirror, the name keeps the end of
+        the url to make the cache directory easier to browse.
+        """
+        normalized = Url(url).normalized()
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', normalized.rstrip('/').split('/')[-1].split(':')[-1])
+        if not name.endswith('.git'):
+            name += '.git'
+        return '{0}-{1}'.format(hashlib.sha1(normalized).hexdigest()[:12], name)
+
+    def mirror_path(self, url):
+        return os.path.join(self.path, self.key(url))
+
+    @contextmanager
+    def _locked(self, key):
+        """hold an exclusive lock on a mirror, across threads & processes"""
+        with open(os.path.join(self.path, '{0}.lock'.format(key)), 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def ensure(self, url):
+        """Return the path to an up to date mirror of url
+
+        The mirror is cloned if it doesn't exist yet, otherwise fetched, but
+        only the first time it's asked for by this MirrorCache.
+        """
+        key = self.key(url)
+        mirror = os.path.join(self.path, key)
+
+        with self._locked(key):
+            with self._used_lock:
+                fresh = key in self._used
+                self._used.add(key)
+
+            if not os.path.isdir(mirror):
+                LOG.info("Mirroring {0} into the cache".format(url))
+                # clone to one side & rename, so an interrupted clone never
+                # leaves a broken mirror behind
+                tmp = tempfile.mkdtemp(prefix='.{0}.'.format(key), dir=self.path)
+                try:
+                    with timed('clone'):
+                        git.clone('--mirror', '--quiet', url, tmp)
+                    os.rename(tmp, mirror)
+                except BaseException:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+            elif not fresh:
+                LOG.info("Refreshing the cached mirror of {0}".format(url))
+                with timed('fetch'):
+                    git.fetch('--prune', '--quiet', 'origin', _cwd=mirror)
+
+            # the mtime records when a mirror was last used, for trim()
+            os.utime(mirror, None)
+
+        return mirror
+
+    def trim(self):
+        """Evict the least recently used mirrors until the cache fits maxsize
+
+        Mirrors used by this MirrorCache are never evicted.
+        """
+        if self.maxsize is None:
+            return
+
+        mirrors = []
+        total = 0
+        for name in os.listdir(self.path):
+            mirror = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(mirror):
+                continue
+            size = _du(mirror)
+            total += size
+            mirrors.append((os.path.getmtime(mirror), name, size))
+
+        # oldest first
+        for mtime, name, size in sorted(mirrors):
+            if total <= self.maxsize:
+                break
+            if name in self._used:
+                continue
+            with self._locked(name):
+                LOG.info("Evicting {0} from the mirror cache".format(name))
+                shutil.rmtree(os.path.join(self.path, name))
+            total -= size
+
+
+def _du(path):
+    """total size in bytes of the files under path"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
@@ -15,13 +15,24 @@
 # under the License.
 import logging
 import yaml
-import re
-from gitshelf.utils import NestedDict
+from gitshelf.utils import NestedDict, get_item_properties
 from gitshelf.book import Book
+from gitshelf.config import ConfigCache
+from gitshelf.engine import Engine
+from gitshelf.exceptions import UnresolvedTokens
+from gitshelf.index import BookIndex
+from gitshelf.result import BookResult, exit_status
+from gitshelf.ssh import SshMultiplexer
+from gitshelf.timing import Profiler
+from gitshelf.tokens import Template, environment_tokens
 from cliff.command import Command
+from cliff.lister import Lister
 
 LOG = logging.getLogger(__name__)
 
+# the C loader is many times faster on large shelves, when PyYAML has it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 class BaseCommand(Command):
     """ Parent Command object for gitshelf """
@@ -58,6 +69,20 @@ class BaseCommand(Command):
                             help='set the desired environment, overriding any default'
                                  'settings in the config file (gitshelf.yml)')
 
+        parser.add_argument('--strict-tokens',
+                            dest='stricttokens',
+                            default=False,
+                            help='fail if the config uses tokens the environment has no value for, '
+                                 'rather than replacing them with nothing',
+                            action='store_true')
+
+        parser.add_argument('--no-config-cache',
+                            dest='configcache',
+                            default=True,
+                            help='always re-read & render the gitshelf YAML, rather than reusing '
+                                 'the cached rendering of an unchanged file',
+                            action='store_false')
+
         parser.add_argument('--dry-run',
                             default=False,
                             help="Defaults to False",
@@ -70,6 +95,64 @@ class BaseCommand(Command):
                                  'Skip the repo remote host check',
                             action='store_true')
 
+        parser.add_argument('--jobs', '-j',
+                            dest='jobs',
+                            default=1,
+                            type=int,
+                            help='number of books to work on in parallel, defaults to 1',
+                            action='store')
+
+        parser.add_argument('--timeout',
+                            dest='timeout',
+                            default=None,
+                            type=float,
+                            help='seconds each book may take before its git commands are killed, '
+                                 'defaults to no limit',
+                            action='store')
+
+        parser.add_argument('--only',
+                            dest='only',
+                            default=[],
+                            metavar='SELECTOR',
+                            help='only work on the books matching SELECTOR, a glob of book paths, '
+                                 'tag:NAME or host:NAME, may be repeated',
+                            action='append')
+
+        parser.add_argument('--exclude',
+                            dest='exclude',
+                            default=[],
+                            metavar='SELECTOR',
+                            help='skip the books matching SELECTOR, as for --only, may be repeated',
+                            action='append')
+
+        parser.add_argument('--profile',
+                            default=False,
+                            help='report where the time went, the slowest books, time in git & '
+                                 'counts of git commands, on stderr',
+                            action='store_true')
+
+        parser.add_argument('--profile-trace',
+                            dest='profiletrace',
+                            default=None,
+                            metavar='FILE',
+                            help='write a Chrome trace of every book operation & git command to FILE',
+                            action='store')
+
+        parser.add_argument('--ssh-per-host',
+                            dest='sshperhost',
+                            default=4,
+                            type=int,
+                            help='number of git commands that may share the connection to an ssh '
+                                 'host at once, 0 for no limit, defaults to 4',
+                            action='store')
+
+        parser.add_argument('--no-ssh-multiplex',
+                            dest='sshmultiplex',
+                            default=True,
+                            help='open a new ssh connection for every git command, rather than '
+                                 'sharing one per host',
+                            action='store_false')
+
         return parser
 
     def post_execute(self, data):
@@ -84,76 +167,151 @@ class BaseCommand(Command):
 
     def take_action(self, parsed_args):
         # TODO: Common Exception Handling Here
-        results = self.execute(parsed_args)
+        results = self._profiled(parsed_args)
         return self.post_execute(results)
 
-    def _parse_configuration(self, parsed_args):
-        # Read the main config file
-        LOG.debug(parsed_args)
-        config_file = parsed_args.gitshelf.pop() if isinstance(parsed_args.gitshelf, list) else parsed_args.gitshelf
+    def _profiled(self, parsed_args):
+        """Run execute(), profiling it if --profile or --profile-trace was given"""
+        profile = getattr(parsed_args, 'profile', False)
+        trace = getattr(parsed_args, 'profiletrace', None)
+        if not (profile or trace):
+            return self.execute(parsed_args)
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return self.execute(parsed_args)
+        finally:
+            profiler.stop()
+            if profile:
+                for line in profiler.report():
+                    self.app.stderr.write('{0}\n'.format(line))
+            if trace:
+                profiler.write_trace(trace)
+
+    def _config_file(self, parsed_args):
+        config_file = parsed_args.gitshelf[0] if isinstance(parsed_args.gitshelf, list) else parsed_args.gitshelf
         LOG.debug("config_file = {0}".format(config_file))
+        return config_file
+
+    @staticmethod
+    def _load_configuration(config_raw):
+        """Parse the raw YAML of a gitshelf config"""
+        return NestedDict(yaml.load(config_raw, Loader=YAML_LOADER) or {})
+
+    def _check_tokens(self, parsed_args, environment, unresolved):
+        """Complain about unresolved tokens, raising UnresolvedTokens if --strict-tokens"""
+        if not unresolved:
+            return
+        if parsed_args.stricttokens:
+            raise UnresolvedTokens(environment, unresolved)
+        LOG.warning("WARNING environment {0} has no value for the token(s) {1}, "
+                    "replacing them with nothing".format(environment, ', '.join(unresolved)))
 
-        with open(config_file) as fh:
-            config = NestedDict(yaml.load(fh))
+    def _parse_configuration(self, parsed_args):
+        # Read the main config file, once
+        LOG.debug(parsed_args)
+        config_file = self._config_file(parsed_args)
 
-        with open(config_file) as fh:
+        with open(config_file, 'rb') as fh:
             config_raw = fh.read()
 
-        if parsed_args.environment:
-            environment = parsed_args.environment[0]
-        else:
-            environment = config['defaults'].get('environment', 'dev')
+        cli_environment = parsed_args.environment[0] if parsed_args.environment else None
+        cli_tokens = [cli_token[0] for cli_token in parsed_args.tokens or []]
 
-        tokens = config['environments'][environment]['tokens']
-        LOG.debug('Tokens: {0}'.format(tokens))
+        # the rendered config only depends on the file, environment & tokens,
+        # so reuse the last rendering if none of those have changed
+        cache = None
+        rendering = None
+        if parsed_args.configcache:
+            cache = ConfigCache()
+            digest = ConfigCache.digest(config_raw)
+            rendering = cache.get(config_file, cli_environment, cli_tokens, digest)
 
-        # overwrite the tokens loaded from the file with any passed on the
-        # command line
-        if parsed_args.tokens:
-            LOG.debug("Tokens have been passed on the command line: {0}".format(parsed_args.tokens))
-            # split them into key/value pair, but we are passed a list of lists
-            # so cli_token[0] accessess the item we want
-            for cli_token in parsed_args.tokens:
-                LOG.debug("Parsing the command line token: {0}".format(cli_token))
-                split_token = cli_token[0].partition("=")
-                LOG.debug("Split command line token: {0}".format(split_token))
-                tokens[split_token[0]] = split_token[2]
+        if rendering is None:
+            config = self._load_configuration(config_raw)
+            environment = cli_environment or config['defaults'].get('environment', 'dev')
+            tokens = environment_tokens(config, environment, cli_tokens)
+            config, unresolved = Template(config).render(tokens)
+            rendering = {'environment': environment, 'config': config, 'unresolved': unresolved}
 
-            LOG.debug('Tokens: {0}'.format(tokens))
+            if cache is not None:
+                cache.put(config_file, cli_environment, cli_tokens, digest, rendering)
 
-        # expand out tokens, tokens are {} wrapped names from the environment section
-        delimiters = ('{', '}')
+        LOG.debug(rendering['config'])
+        self._check_tokens(parsed_args, rendering['environment'], rendering['unresolved'])
 
-        def _replaceToken(match):
-            # Strip the delimiter with 1:-1
-            key = match.group(0)[1:-1]
-            if key in tokens:
-                return tokens[key]    # Strip the delimiter with 1:-1
-            return ''
+        return rendering['config']
 
-        rendered_config = re.sub('\%s.*?\%s' % delimiters, _replaceToken, config_raw)
+    def _engine(self, parsed_args):
+        """The engine to work on books with, honouring --jobs & --timeout"""
+        return Engine(jobs=parsed_args.jobs, timeout=parsed_args.timeout)
 
-        # reload the config block from the rendered yaml
-        config = yaml.load(rendered_config)
+    def _run_books(self, parsed_args, books, action):
+        """Run the named Book method on every book, through the shared engine
 
-        LOG.debug(config)
+        Returns a list of (book, value, error) tuples, in the same order as
+        books.
+        """
+        return self._engine(parsed_args).run(books, action)
+
+    def _book_results(self, parsed_args, books, action):
+        """Run the named Book method on every book, returning a BookResult for each
 
-        return config
+        Books whose operation failed get a BookResult in the error state.
+        """
+        return [BookResult.failed(book, error) if error is not None else value
+                for book, value, error in self._run_books(parsed_args, books, action)]
 
-    def _get_books(self, parsed_args, config):
+    def _ssh_multiplexer(self, parsed_args):
+        """Start sharing ssh connections for this run, returns None if disabled
 
-        LOG.debug("parsed_args: {0}".format(parsed_args))
-        LOG.debug("config: {0}".format(config))
+        The caller must close() the multiplexer once it's finished with git.
+        """
+        if not parsed_args.sshmultiplex:
+            return None
+        ssh = SshMultiplexer(per_host=parsed_args.sshperhost)
+        ssh.start()
+        return ssh
+
+    def _get_books(self, parsed_args, config, defaults=None):
+        """Build the list of Book objects from the configuration
+
+        defaults is a dict of Book arguments used for any book that doesn't
+        set them itself, None values are ignored.  Only the books picked by
+        the --only & --exclude selectors are returned.
+        """
+
+        LOG.debug("parsed_args: %s", parsed_args)
+        LOG.debug("config: %s", config)
 
         # load the config into an array of Book objects
-        books = []
-        for book in config['books']:
-            LOG.debug("Fresh book: {0}".format(book))
-            book.update({'fakeroot': parsed_args.fakeroot})
-            LOG.debug("Final book: {0}".format(book))
-            # the dictionary we get from the parsed configuration should
-            # match the named parameters to the Book class, so we use
-            # ** to unpack the dictionary to the class arguments
-            books.append(Book(**book))
-
-        return books
+        books = Book.from_config(config['books'], fakeroot=parsed_args.fakeroot, **(defaults or {}))
+        books = [(book.book, book) for book in books]
+
+        return BookIndex(books).select(only=parsed_args.only, exclude=parsed_args.exclude)
+
+
+class BaseLister(BaseCommand, Lister):
+    """ Parent Lister for gitshelf commands reporting a result per book
+
+        execute() returns a list of BookResult objects, which are output
+        with cliff's formatters (-f table, json, csv, ...).  The exit status
+        is 2 if any book failed, 1 if any book has drifted, otherwise 0.
+    """
+
+    columns = ('Path', 'Kind', 'State', 'Sha1', 'Seconds', 'Error')
+
+    formatters = {'Seconds': lambda result: round(sum(result.timings.values()), 3)}
+
+    exit_code = 0
+
+    def take_action(self, parsed_args):
+        results = self._profiled(parsed_args)
+        self.exit_code = exit_status(results)
+        return (self.columns,
+                [get_item_properties(result, self.columns, formatters=self.formatters) for result in results])
+
+    def run(self, parsed_args):
+        super(BaseLister, self).run(parsed_args)
+        return self.exit_code
@@ -13,15 +13,63 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import errno
 import logging
-from gitshelf.cli import BaseCommand
+import os
+import shutil
+import tempfile
+from gitshelf.cli import BaseLister
+from gitshelf.result import BookResult
+from gitshelf.utils import parse_size
 
 LOG = logging.getLogger(__name__)
 
+# diffs being written to stdout are held in memory up to this size while
+# they wait for the books before them, then spill to a temporary file
+SPOOL_SIZE = 1024 * 1024
 
-class GitShelfDiffCommand(BaseCommand):
+
+class GitShelfDiffCommand(BaseLister):
     """ Check a set of repos for changes"""
 
+    columns = ('Path', 'Kind', 'State', 'Sha1', 'Bytes', 'Truncated', 'Output', 'Seconds', 'Error')
+
+    def get_parser(self, prog_name):
+        parser = super(GitShelfDiffCommand, self).get_parser(prog_name)
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--stat',
+                          dest='mode',
+                          default='patch',
+                          const='stat',
+                          help='show a summary of the changed files & lines, rather than the full diff',
+                          action='store_const')
+        mode.add_argument('--name-only',
+                          dest='mode',
+                          const='name-only',
+                          help='show only the names of the changed files',
+                          action='store_const')
+        # not --quiet, cliff already has that for the log
+        mode.add_argument('--exit-code-only',
+                          dest='mode',
+                          const='quiet',
+                          help='show no diff, only whether each book has changes, as git diff --quiet',
+                          action='store_const')
+        parser.add_argument('--output-dir',
+                            dest='outputdir',
+                            default=None,
+                            metavar='DIR',
+                            help='write the diff of each changed book to DIR/<book>.diff, rather '
+                                 'than stdout (or stderr with -f other than table)',
+                            action='store')
+        parser.add_argument('--max-bytes',
+                            dest='maxbytes',
+                            default=None,
+                            metavar='SIZE',
+                            help='truncate the diff of each book at SIZE (e.g. 10M), defaults to '
+                                 'no limit',
+                            action='store')
+        return parser
+
     def execute(self, parsed_args):
         """execute, something to do for this command."""
         # load the configuration from yaml, rendering
@@ -31,6 +79,69 @@ class GitShelfDiffCommand(BaseCommand):
         # get back the collection of books
         books = self._get_books(parsed_args, config)
 
-        # now iterate over the list of book objects
-        for book in books:
-            book.diff()
+        mode = parsed_args.mode
+        max_bytes = parse_size(parsed_args.maxbytes) if parsed_args.maxbytes else None
+
+        if mode == 'quiet':
+            def diff(book):
+                return book.diff(mode='quiet')
+
+            return self._book_results(parsed_args, books, diff)
+
+        if parsed_args.outputdir:
+            def diff(book):
+                return self._diff_to_file(book, parsed_args.outputdir, mode, max_bytes)
+
+            return self._book_results(parsed_args, books, diff)
+
+        # each book's diff is spooled while git runs, up to --jobs at a time,
+        # then written out in shelf order, as soon as the books before it are
+        def diff(book):
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            try:
+                result = book.diff(mode=mode, output=spool, max_bytes=max_bytes)
+            except Exception:
+                spool.close()
+                raise
+            result.details['spool'] = spool
+            return result
+
+        # the results table goes to stdout, which the diffs mustn't get
+        # mixed into unless it's just for reading
+        stream = self.app.stdout if parsed_args.formatter == 'table' else self.app.stderr
+
+        results = []
+        for book, value, error in self._engine(parsed_args).irun(books, diff):
+            if error is not None:
+                results.append(BookResult.failed(book, error))
+                continue
+            spool = value.details.pop('spool')
+            if value.details.get('bytes'):
+                stream.write("# book {0}\n".format(value.path))
+                spool.seek(0)
+                shutil.copyfileobj(spool, stream)
+                stream.flush()
+            spool.close()
+            results.append(value)
+        return results
+
+    @staticmethod
+    def _diff_to_file(book, outputdir, mode, max_bytes):
+        """Diff book into outputdir/<book>.diff, removing the file if the book is clean"""
+        path = os.path.join(outputdir, book.path.lstrip(os.sep) + '.diff')
+        if book.kind != 'git':
+            return book.diff(mode=mode)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(path, 'wb') as output:
+            result = book.diff(mode=mode, output=output, max_bytes=max_bytes)
+        if result.details.get('bytes'):
+            result.details['output'] = path
+        else:
+            os.unlink(path)
+        return result
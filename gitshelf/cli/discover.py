@@ -14,12 +14,24 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import logging
+import yaml
+from collections import OrderedDict
 from gitshelf.cli import BaseCommand
 from gitshelf.book import Book
+from gitshelf.utils import atomic_write
 
 LOG = logging.getLogger(__name__)
 
 
+class ShelfDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """ YAML dumper that keeps the keys of a book in the order given """
+
+
+ShelfDumper.add_representer(
+    OrderedDict,
+    lambda dumper, data: dumper.represent_mapping('tag:yaml.org,2002:map', data.items()))
+
+
 class GitShelfDiscoverCommand(BaseCommand):
     """ Discover the git repos & symlinks under this directory """
 
@@ -29,25 +41,91 @@ class GitShelfDiscoverCommand(BaseCommand):
                             default=False,
                             help="Use the branch name instead of the sha1 for pinning",
                             action='store_true')
+        parser.add_argument('--exclude',
+                            dest='exclude',
+                            default=[],
+                            metavar='PATTERN',
+                            help='glob of directory names or paths to skip, may be repeated',
+                            action='append')
+        parser.add_argument('--jobs', '-j',
+                            dest='jobs',
+                            default=1,
+                            type=int,
+                            help='number of repos to inspect in parallel, defaults to 1',
+                            action='store')
+        parser.add_argument('--max-depth',
+                            dest='maxdepth',
+                            default=None,
+                            type=int,
+                            help='how many directory levels to search, defaults to no limit',
+                            action='store')
+        parser.add_argument('--sort',
+                            default=False,
+                            help='sort the books by path before writing any out, this means '
+                                 'holding every book until discovery completes',
+                            action='store_true')
+        parser.add_argument('--output', '-o',
+                            dest='output',
+                            default=None,
+                            help='file to write the gitshelf YAML to, replaced atomically once '
+                                 'discovery completes, defaults to stdout',
+                            action='store')
+        parser.add_argument('--profile',
+                            default=False,
+                            help='report where the time went, the slowest repos, time in git & '
+                                 'counts of git commands, on stderr',
+                            action='store_true')
+        parser.add_argument('--profile-trace',
+                            dest='profiletrace',
+                            default=None,
+                            metavar='FILE',
+                            help='write a Chrome trace of every repo inspected & git command to FILE',
+                            action='store')
         return parser
 
     def execute(self, parsed_args):
         """execute, something to do for this command."""
 
-        # get back the collection of books
-        books = Book.discover(usebranch=parsed_args.use_branch)
+        # get back the collection of books, in path order
+        books = Book.discover(usebranch=parsed_args.use_branch,
+                              exclude=parsed_args.exclude,
+                              maxdepth=parsed_args.maxdepth,
+                              jobs=parsed_args.jobs)
+
+        if parsed_args.sort:
+            books = sorted(books, key=lambda book: book.path)
+
+        if parsed_args.output is None:
+            self._emit(books, self.app.stdout)
+            return
 
-        # sort the list, based on the path attribute
-        books.sort(key=lambda book: book.path)
+        # write to a temporary file alongside the output, then rename it
+        # into place so readers never see a partial shelf
+        with atomic_write(parsed_args.output) as fh:
+            self._emit(books, fh)
 
-        # now iterate over the list of book objects
-        # TODO: be less hacky and use a YAML emitter
-        print "books:"
+    @staticmethod
+    def _emit(books, fh):
+        """Write books to fh as a gitshelf YAML document, one at a time"""
+        count = 0
         for book in books:
-            print "  - book: {0}".format(book.path)
+            if count == 0:
+                fh.write('books:\n')
+            count += 1
+
+            entry = OrderedDict(book=book.path)
             if book.git is not None:
-                print "    git: {0}".format(book.git)
-                print "    branch: {0}".format(book.branch)
+                entry['git'] = book.git
+                entry['branch'] = book.branch
             elif book.link is not None:
-                print "    link: {0}".format(book.link)
-            print
+                entry['link'] = book.link
+
+            # dump each book as a single item list, indented under books:
+            item = yaml.dump([entry], Dumper=ShelfDumper, default_flow_style=False)
+            for line in item.splitlines():
+                fh.write('  {0}\n'.format(line))
+            fh.write('\n')
+            fh.flush()
+
+        if count == 0:
+            fh.write('books: []\n')
@@ -14,14 +14,61 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import logging
-from gitshelf.cli import BaseCommand
+from gitshelf.cache import MirrorCache
+from gitshelf.cli import BaseLister
+from gitshelf.plan import Plan
+from gitshelf.utils import parse_size
 
 LOG = logging.getLogger(__name__)
 
 
-class GitShelfInstallCommand(BaseCommand):
+class GitShelfInstallCommand(BaseLister):
     """ Install a set of repos """
 
+    def get_parser(self, prog_name):
+        parser = super(GitShelfInstallCommand, self).get_parser(prog_name)
+        parser.add_argument('--depth',
+                            dest='depth',
+                            default=None,
+                            type=int,
+                            help='clone books with history truncated to this many commits',
+                            action='store')
+        parser.add_argument('--filter',
+                            dest='filter',
+                            default=None,
+                            metavar='FILTER-SPEC',
+                            help='partial clone filter for books, e.g. blob:none',
+                            action='store')
+        parser.add_argument('--single-branch',
+                            dest='singlebranch',
+                            default=False,
+                            help='clone only the pinned branch/tag of each book',
+                            action='store_true')
+        parser.add_argument('--reference',
+                            dest='reference',
+                            default=None,
+                            metavar='REPO',
+                            help='local repo to borrow objects from when cloning books',
+                            action='store')
+        parser.add_argument('--dissociate',
+                            dest='dissociate',
+                            default=False,
+                            help='copy objects borrowed via --reference into each book',
+                            action='store_true')
+        parser.add_argument('--cache-dir',
+                            dest='cachedir',
+                            default=None,
+                            help='directory of shared mirrors to clone books through, so each '
+                                 'remote is only fetched once, defaults to no cache',
+                            action='store')
+        parser.add_argument('--cache-size',
+                            dest='cachesize',
+                            default=None,
+                            help='trim the mirror cache to this size (e.g. 10G) after installing, '
+                                 'evicting the least recently used mirrors',
+                            action='store')
+        return parser
+
     def execute(self, parsed_args):
         """execute, something to do for this command."""
         # load the configuration from yaml, rendering
@@ -29,8 +76,45 @@ class GitShelfInstallCommand(BaseCommand):
         config = self._parse_configuration(parsed_args)
 
         # get back the collection of books
-        books = self._get_books(parsed_args, config)
+        # command line clone options apply to books that don't set their own
+        clone_defaults = {'depth': parsed_args.depth,
+                          'filter': parsed_args.filter,
+                          'singlebranch': parsed_args.singlebranch or None,
+                          'reference': parsed_args.reference,
+                          'dissociate': parsed_args.dissociate or None}
+
+        cache = None
+        if parsed_args.cachedir:
+            cache = MirrorCache(parsed_args.cachedir,
+                                maxsize=parse_size(parsed_args.cachesize) if parsed_args.cachesize else None)
+            clone_defaults['cache'] = cache
+
+        # work out what each book needs from what's on disk, then only work
+        # on the books that need it, up to --jobs at a time
+        engine = self._engine(parsed_args)
+        ssh = None
+        try:
+            # books on the same ssh host share a connection
+            ssh = self._ssh_multiplexer(parsed_args)
+            clone_defaults['ssh'] = ssh
+
+            books = self._get_books(parsed_args, config, defaults=clone_defaults)
+
+            plan = Plan.make(engine, books, skip_deletes=parsed_args.skip_deletes)
+            if parsed_args.dry_run:
+                self.columns = ('Path', 'Kind', 'Action', 'Reason', 'Error')
+                return plan.results()
+            results = plan.execute(engine)
+        finally:
+            if ssh is not None:
+                ssh.close()
+
+        failed = [result for result in results if result.state == 'error']
+        LOG.info("Installed {0} books, {1} failed".format(len(results) - len(failed), len(failed)))
+        for result in failed:
+            LOG.error("ERROR book {0}: {1}".format(result.path, result.error))
+
+        if cache is not None:
+            cache.trim()
 
-        # now iterate over the list of book objects
-        for book in books:
-            book.create()
+        return results
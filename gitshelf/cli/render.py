@@ -0,0 +1,94 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import os
+import yaml
+from gitshelf.cli import BaseCommand
+from gitshelf.cli.discover import ShelfDumper
+from gitshelf.tokens import Template, environment_tokens
+from gitshelf.utils import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+
+class GitShelfRenderCommand(BaseCommand):
+    """ Render the gitshelf config with its tokens substituted """
+
+    def get_parser(self, prog_name):
+        parser = super(GitShelfRenderCommand, self).get_parser(prog_name)
+        parser.add_argument('--all-environments',
+                            dest='allenvironments',
+                            default=False,
+                            help='render the config for every environment it defines, in one pass',
+                            action='store_true')
+        parser.add_argument('--output-dir',
+                            dest='outputdir',
+                            default=None,
+                            help='write each rendered environment to <environment>.yml in this '
+                                 'directory, rather than to stdout',
+                            action='store')
+        return parser
+
+    def execute(self, parsed_args):
+        """execute, something to do for this command."""
+
+        with open(self._config_file(parsed_args), 'rb') as fh:
+            config = self._load_configuration(fh.read())
+
+        template = Template(config)
+        cli_tokens = [cli_token[0] for cli_token in parsed_args.tokens or []]
+
+        if parsed_args.allenvironments:
+            rendered = template.render_environments(cli_tokens)
+        else:
+            if parsed_args.environment:
+                environment = parsed_args.environment[0]
+            else:
+                environment = config['defaults'].get('environment', 'dev')
+            rendered = {environment: template.render(environment_tokens(config, environment, cli_tokens))}
+
+        # report every environment before failing, so one run lists them all
+        failed = 0
+        for environment in sorted(rendered):
+            config, unresolved = rendered[environment]
+            if unresolved and parsed_args.stricttokens:
+                LOG.error("ERROR environment {0} has no value for the token(s) {1}".format(
+                    environment, ', '.join(unresolved)))
+                failed += 1
+            else:
+                self._check_tokens(parsed_args, environment, unresolved)
+
+        if failed:
+            return 1
+
+        if parsed_args.outputdir is not None and not os.path.isdir(parsed_args.outputdir):
+            os.makedirs(parsed_args.outputdir)
+
+        for environment in sorted(rendered):
+            config = rendered[environment][0]
+            if parsed_args.outputdir is None:
+                if len(rendered) > 1:
+                    self.app.stdout.write('--- # {0}\n'.format(environment))
+                self._emit(config, self.app.stdout)
+            else:
+                path = os.path.join(parsed_args.outputdir, '{0}.yml'.format(environment))
+                with atomic_write(path) as fh:
+                    self._emit(config, fh)
+                LOG.info("# rendered environment {0} to {1}".format(environment, path))
+
+    @staticmethod
+    def _emit(config, fh):
+        yaml.dump(config, fh, Dumper=ShelfDumper, default_flow_style=False)
@@ -14,23 +14,58 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import logging
-from gitshelf.cli import BaseCommand
+from gitshelf.cli import BaseLister
+from gitshelf.state import StateFile
 
 LOG = logging.getLogger(__name__)
 
 
-class GitShelfStatusCommand(BaseCommand):
+class GitShelfStatusCommand(BaseLister):
     """ Check a set of repos for existance & cleaness"""
 
+    columns = ('Path', 'Kind', 'State', 'Sha1', 'Head', 'Upstream', 'Ahead', 'Behind',
+               'Staged', 'Modified', 'Unmerged', 'Untracked', 'Target', 'Seconds', 'Error')
+
+    def get_parser(self, prog_name):
+        parser = super(GitShelfStatusCommand, self).get_parser(prog_name)
+        parser.add_argument('--state',
+                            dest='state',
+                            default=None,
+                            help='record the status of each book in a state file, & report the recorded '
+                                 'status of books whose HEAD, index, fetched refs & link target are '
+                                 'unchanged since, without running git',
+                            action='store_true')
+        parser.add_argument('--state-file',
+                            dest='statefile',
+                            default=None,
+                            help='state file to use, implies --state, defaults to one per shelf under '
+                                 '$XDG_CACHE_HOME/gitshelf/state',
+                            action='store')
+        parser.add_argument('--no-state',
+                            dest='state',
+                            help='check every book, ignoring & not updating the state file, the default',
+                            action='store_false')
+        return parser
+
     def execute(self, parsed_args):
         """execute, something to do for this command."""
         # load the configuration from yaml, rendering
         # any tokens along the way
         config = self._parse_configuration(parsed_args)
 
+        # with a state file, books unchanged since the last run keep their last status
+        state = None
+        if parsed_args.state or (parsed_args.state is None and parsed_args.statefile):
+            state = StateFile(parsed_args.statefile or
+                              StateFile.default_path(self._config_file(parsed_args), parsed_args.fakeroot))
+
         # get back the collection of books
-        books = self._get_books(parsed_args, config)
+        books = self._get_books(parsed_args, config, defaults={'state': state})
+
+        # check every book, up to --jobs at a time
+        results = self._book_results(parsed_args, books, 'status')
+
+        if state is not None:
+            state.save()
 
-        # now iterate over the list of book objects
-        for book in books:
-            book.status()
+        return results
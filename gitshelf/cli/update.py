@@ -0,0 +1,147 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import os
+from collections import OrderedDict
+from gitshelf.cache import MirrorCache
+from gitshelf.cli import BaseLister
+from gitshelf.gitdir import GitDir, ABBREV_SHA1_RE, SHA1_RE
+from gitshelf.result import BookResult
+from gitshelf.utils import Url
+
+LOG = logging.getLogger(__name__)
+
+# the refspec of a clone that fetches every branch of origin
+ALL_BRANCHES = '+refs/heads/*:refs/remotes/origin/*'
+
+
+class GitShelfUpdateCommand(BaseLister):
+    """ Fetch a set of repos & move them forward to their pinned branch/tag/sha1 """
+
+    columns = ('Path', 'Kind', 'State', 'From', 'To', 'Seconds', 'Error')
+
+    def get_parser(self, prog_name):
+        parser = super(GitShelfUpdateCommand, self).get_parser(prog_name)
+        parser.add_argument('--cache-dir',
+                            dest='cachedir',
+                            default=None,
+                            help='directory of shared mirrors to fetch books through, as for install',
+                            action='store')
+        return parser
+
+    def execute(self, parsed_args):
+        """execute, something to do for this command."""
+        # load the configuration from yaml, rendering
+        # any tokens along the way
+        config = self._parse_configuration(parsed_args)
+
+        defaults = {}
+        if parsed_args.cachedir:
+            defaults['cache'] = MirrorCache(parsed_args.cachedir)
+
+        ssh = None
+        try:
+            # books on the same ssh host share a connection
+            ssh = self._ssh_multiplexer(parsed_args)
+            defaults['ssh'] = ssh
+
+            # get back the collection of books, only repos can be updated,
+            # those that don't exist have nothing to fetch & report missing
+            books = [book for book in self._get_books(parsed_args, config, defaults=defaults)
+                     if book.git is not None]
+
+            fetch_failed = self._fetch(parsed_args, [book for book in books if os.path.exists(book.path)])
+            updated = self._book_results(parsed_args, [book for book in books if book not in fetch_failed], 'update')
+        finally:
+            if ssh is not None:
+                ssh.close()
+
+        # back in shelf order, with the books that couldn't be fetched
+        updated = dict((result.path, result) for result in updated)
+        results = [updated.get(book.path) or BookResult.failed(book, fetch_failed[book]) for book in books]
+
+        failed = [result for result in results if result.state == 'error']
+        moved = [result for result in results if result.state == 'moved']
+        missing = [result for result in results if result.state == 'missing']
+        LOG.info("Updated {0} books, {1} moved, {2} missing, {3} failed".format(
+            len(books) - len(failed) - len(missing), len(moved), len(missing), len(failed)))
+        for result in moved:
+            LOG.info("# book {0}: {1} -> {2}".format(result.path, result.details['from'], result.details['to']))
+        for result in failed:
+            LOG.error("ERROR book {0}: {1}".format(result.path, result.error))
+
+        return results
+
+    def _fetch(self, parsed_args, books):
+        """Fetch every book, each remote only once
+
+        The first book of each remote fetches it over the network, the
+        other books sharing the remote then fetch from that book locally.
+        With a mirror cache the mirror is only fetched once anyway, so each
+        book fetches from it.  Returns a dict of the books that failed to
+        fetch, to their errors.
+        """
+        if books and books[0].cache is not None:
+            return dict((book, error) for book, value, error in self._run_books(parsed_args, books, 'fetch')
+                        if error is not None)
+
+        # shallow repos can't be fetched from reliably & single branch
+        # repos only fetch some of the remote, they fetch for themselves
+        remotes = OrderedDict()
+        solo = []
+        for book in books:
+            gitdir = GitDir(book.path)
+            if os.path.exists(os.path.join(gitdir.common or '', 'shallow')) or \
+                    ALL_BRANCHES not in gitdir.fetch_refspecs():
+                solo.append(book)
+            else:
+                remotes.setdefault(Url(book.git).normalized(), []).append(book)
+
+        leaders = [siblings[0] for siblings in remotes.values()] + solo
+        failed = dict((book, error) for book, value, error in self._run_books(parsed_args, leaders, 'fetch')
+                      if error is not None)
+
+        # siblings of a book that failed to fetch try the network themselves
+        sources = OrderedDict()
+        for siblings in remotes.values():
+            for book in siblings[1:]:
+                sources[book] = siblings[0].path if siblings[0] not in failed else None
+
+        def fetch(book):
+            book.fetch(source=sources[book])
+            if sources[book] is not None and not self._has_upstream(book):
+                # the branch the book follows didn't come across from its
+                # sibling, go to the network for it
+                book.fetch()
+
+        for book, value, error in self._run_books(parsed_args, list(sources), fetch):
+            if error is not None:
+                failed[book] = error
+
+        return failed
+
+    @staticmethod
+    def _has_upstream(book):
+        """Check if the remote branch a book pinned to a branch follows has been fetched
+
+        Books pinned to a tag or sha1 have nothing to follow, so they're
+        always fine.
+        """
+        gitdir = GitDir(book.path)
+        if gitdir.lookup('refs/tags/{0}'.format(book.branch)) is not None or \
+                SHA1_RE.match(book.branch) or ABBREV_SHA1_RE.match(book.branch):
+            return True
+        return gitdir.lookup('refs/remotes/origin/{0}'.format(book.branch)) is not None
@@ -0,0 +1,73 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+from gitshelf.cli import BaseCommand
+from gitshelf.watch import Watcher
+
+LOG = logging.getLogger(__name__)
+
+
+class GitShelfWatchCommand(BaseCommand):
+    """ Watch a set of repos, keeping their status up to date as they change """
+
+    def get_parser(self, prog_name):
+        parser = super(GitShelfWatchCommand, self).get_parser(prog_name)
+        parser.add_argument('--drift-file',
+                            dest='driftfile',
+                            default=None,
+                            help='JSON file to keep the status of every book in, replaced '
+                                 'atomically whenever a book changes',
+                            action='store')
+        parser.add_argument('--socket',
+                            dest='socket',
+                            default=None,
+                            help='unix socket to serve the status of every book on, as JSON',
+                            action='store')
+        parser.add_argument('--interval',
+                            dest='interval',
+                            default=10,
+                            type=float,
+                            help='seconds between polls, or between looks for missing books when '
+                                 'using inotify, defaults to 10',
+                            action='store')
+        parser.add_argument('--poll',
+                            default=False,
+                            help='poll the books rather than use inotify, which needs pyinotify',
+                            action='store_true')
+        return parser
+
+    def execute(self, parsed_args):
+        """execute, something to do for this command."""
+        # load the configuration from yaml, rendering
+        # any tokens along the way
+        config = self._parse_configuration(parsed_args)
+
+        # get back the collection of books
+        books = self._get_books(parsed_args, config)
+
+        watcher = Watcher(books,
+                          engine=self._engine(parsed_args),
+                          interval=parsed_args.interval,
+                          poll=parsed_args.poll,
+                          drift_file=parsed_args.driftfile,
+                          socket_path=parsed_args.socket)
+        if watcher.poll and not parsed_args.poll:
+            LOG.warning("WARNING pyinotify isn't installed, polling every {0}s instead".format(parsed_args.interval))
+
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
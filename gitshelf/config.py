@@ -0,0 +1,77 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import hashlib
+import json
+import logging
+import os
+from gitshelf.utils import atomic_write, cache_home
+
+LOG = logging.getLogger(__name__)
+
+
+class ConfigCache(object):
+    """ On disk cache of rendered gitshelf configurations
+
+        Each (config file, environment, tokens) combination has one cache
+        entry, holding a digest of the config file it was rendered from, so
+        an edited config file is simply re-rendered & replaces the entry.
+
+        Keyword arguments:
+            path -- directory holding the cache, defaults to
+                    $XDG_CACHE_HOME/gitshelf/config
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_home(), 'config')
+
+    @staticmethod
+    def digest(config_raw):
+        return hashlib.sha1(config_raw).hexdigest()
+
+    def _entry(self, config_file, environment, tokens):
+        key = json.dumps([os.path.abspath(config_file), environment, tokens])
+        return os.path.join(self.path, '{0}.json'.format(hashlib.sha1(key).hexdigest()))
+
+    def get(self, config_file, environment, tokens, digest):
+        """Return the cached rendering, or None if it's missing or stale"""
+        try:
+            with open(self._entry(config_file, environment, tokens)) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('digest') != digest:
+            return None
+
+        LOG.debug("Using the cached rendering of {0}".format(config_file))
+        return entry.get('rendering')
+
+    def put(self, config_file, environment, tokens, digest, rendering):
+        """Cache a rendered config, failing quietly as the cache is only an optimisation"""
+        try:
+            data = json.dumps({'digest': digest, 'rendering': rendering})
+        except (TypeError, ValueError) as e:
+            # e.g. YAML dates, which JSON can't hold
+            LOG.debug("Not caching {0}: {1}".format(config_file, e))
+            return
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with atomic_write(self._entry(config_file, environment, tokens)) as fh:
+                fh.write(data)
+        except (IOError, OSError) as e:
+            LOG.debug("Not caching {0}: {1}".format(config_file, e))
@@ -0,0 +1,186 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from gitshelf.exceptions import BookTimeout, Cancelled
+from gitshelf.timing import operation
+
+LOG = logging.getLogger(__name__)
+
+# python 2 can't interrupt a plain .get() on a pool result, so we wait
+# with a (very long) timeout to keep ^C working
+_WAIT_FOREVER = 60 * 60 * 24 * 365
+
+# the deadline & cancellation flag of the book being worked on, per thread
+_context = threading.local()
+
+
+def remaining():
+    """Seconds left for the book being worked on by this thread
+
+    Returns None if there's no time limit.  Raises Cancelled if the run
+    has been cancelled and BookTimeout once the book is out of time, so
+    calling this before each git command stops work on the book promptly.
+    """
+    cancelled = getattr(_context, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled('cancelled')
+
+    deadline = getattr(_context, 'deadline', None)
+    if deadline is None:
+        return None
+
+    left = deadline - time.time()
+    if left <= 0:
+        raise BookTimeout('timed out')
+    return left
+
+
+class Engine(object):
+    """ Run book operations side by side, shared by every shelf command
+
+        Books are handed to a pool of worker threads, books run git with an
+        explicit working directory so they can safely be worked on side by
+        side.  Each book's operation can be given a time limit, any git
+        command still running when it's reached is killed.
+
+        Keyword arguments:
+            jobs -- number of books to work on at once, 1 runs serially in
+                    the calling thread
+            timeout -- seconds each book's operation may take, None for
+                       no limit
+    """
+
+    def __init__(self, jobs=1, timeout=None):
+        self.jobs = max(jobs or 1, 1)
+        self.timeout = timeout
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Start no more books, and stop those in progress at their next git command"""
+        self._cancelled.set()
+
+    def _run_action(self, args):
+        """Run a single book action, trapping any failure
+
+        Returns a (book, value, error) tuple, value is whatever the action
+        returned & error is None if it succeeded.  Failures are trapped so
+        that one bad book doesn't abort the rest of the shelf.
+        """
+        book, action = args
+        if self._cancelled.is_set():
+            return (book, None, 'cancelled')
+
+        name = getattr(action, '__name__', action)
+        started = time.time()
+        _context.cancelled = self._cancelled
+        _context.deadline = started + self.timeout if self.timeout else None
+        try:
+            with operation(book.path, name):
+                if callable(action):
+                    value = action(book)
+                else:
+                    value = getattr(book, action)()
+            # results (BookResult) record how long each operation took
+            timings = getattr(value, 'timings', None)
+            if timings is not None:
+                timings[name] = time.time() - started
+            return (book, value, None)
+        except Exception as e:
+            # git's own complaint is more use than sh's summary of the command
+            error = (getattr(e, 'stderr', None) or str(e)).strip()
+            LOG.error("ERROR {0} of book {1} failed: {2}".format(name, book.path, error))
+            return (book, None, error)
+        finally:
+            _context.cancelled = None
+            _context.deadline = None
+
+    def run(self, books, action):
+        """Run the named Book method against every book
+
+        Keyword arguments:
+            books -- list of Book objects
+            action -- name of the Book method to call, e.g. 'create', or a
+                      function to call with each book
+
+        Returns a list of (book, value, error) tuples, in the same order as
+        books.
+        """
+        work = [(book, action) for book in books]
+        if self.jobs <= 1 or len(work) <= 1:
+            try:
+                return [self._run_action(item) for item in work]
+            except KeyboardInterrupt:
+                self.cancel()
+                raise
+
+        pool = ThreadPool(processes=min(self.jobs, len(work)))
+        try:
+            results = pool.map_async(self._run_action, work, chunksize=1).get(_WAIT_FOREVER)
+            pool.close()
+        except BaseException:
+            self.cancel()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return results
+
+    def irun(self, books, action):
+        """As run(), but yield each (book, value, error) tuple as soon as it's ready
+
+        Tuples are still yielded in the same order as books, so a book's
+        output can be written as soon as it and every book before it is
+        done.
+        """
+        return self.imap(self._run_action, ((book, action) for book in books))
+
+    def imap(self, func, iterable):
+        """Call func on each item of iterable, from up to `jobs` threads
+
+        Results are yielded in the same order as iterable, each as soon as
+        it (and everything before it) is ready.  iterable is consumed lazily,
+        so items can still be being generated while the first results come
+        back.
+        """
+        if self.jobs <= 1:
+            for item in iterable:
+                yield func(item)
+            return
+
+        pool = ThreadPool(processes=self.jobs)
+        try:
+            results = pool.imap(func, iterable)
+            while True:
+                try:
+                    yield results.next(_WAIT_FOREVER)
+                except StopIteration:
+                    break
+            pool.close()
+        except BaseException:
+            self.cancel()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def imap(func, iterable, jobs=1):
+    """Call func on each item of iterable, from up to `jobs` threads, see Engine.imap"""
+    return Engine(jobs=jobs).imap(func, iterable)
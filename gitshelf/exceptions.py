@@ -17,3 +17,42 @@
 
 class Base(Exception):
     pass
+
+
+class BookTimeout(Base):
+    pass
+
+
+class Cancelled(Base):
+    pass
+
+
+class GitFailed(Base):
+    """ A git command run without sh exited with an error
+
+        Keyword arguments:
+            command -- the git command, e.g. diff
+            exit_code -- git's exit status
+            stderr -- what git said about it
+    """
+
+    def __init__(self, command, exit_code, stderr):
+        super(GitFailed, self).__init__("git {0} exited {1}: {2}".format(command, exit_code, stderr))
+        self.command = command
+        self.exit_code = exit_code
+        self.stderr = stderr
+
+
+class UnresolvedTokens(Base):
+    """ The config uses tokens its environment doesn't define
+
+        Keyword arguments:
+            environment -- name of the environment being rendered
+            tokens -- list of the unresolved token names
+    """
+
+    def __init__(self, environment, tokens):
+        super(UnresolvedTokens, self).__init__(
+            "environment {0} has no value for the token(s) {1}".format(environment, ', '.join(tokens)))
+        self.environment = environment
+        self.tokens = tokens
@@ -0,0 +1,226 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import os
+import re
+
+LOG = logging.getLogger(__name__)
+
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+ABBREV_SHA1_RE = re.compile(r'^[0-9a-f]{4,39}$')
+
+# the order git itself tries when turning a short name into a ref,
+# see gitrevisions(7)
+_REF_RULES = ('{0}',
+              'refs/{0}',
+              'refs/tags/{0}',
+              'refs/heads/{0}',
+              'refs/remotes/{0}',
+              'refs/remotes/{0}/HEAD')
+
+# symbolic refs can point at symbolic refs, git gives up after 5 levels
+_MAX_SYMREF_DEPTH = 5
+
+# a section header of git's config, [section] or [section "subsection"]
+_CONFIG_SECTION_RE = re.compile(r'^\[\s*([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+
+# a `fetch = <refspec>` setting in a config section
+_CONFIG_FETCH_RE = re.compile(r'^fetch\s*=\s*(\S+)\s*$', re.IGNORECASE)
+
+
+class GitDir(object):
+    """ Read HEAD and refs straight from a repo's .git directory
+
+        Answering questions about HEAD from the files git keeps on disk saves
+        starting a git process for each one.  Anything that can't be answered
+        from the files alone (missing refs, loose annotated tags, ...) comes
+        back as None, so that callers can fall back to running git.
+
+        Keyword arguments:
+            worktree -- path to the working tree containing .git
+    """
+
+    def __init__(self, worktree):
+        self.worktree = worktree
+        self.path = None
+        self.common = None
+        self._packed_refs = None
+        self._peeled = False
+
+        dot_git = os.path.join(worktree, '.git')
+        if os.path.isdir(dot_git):
+            self.path = dot_git
+        elif os.path.isfile(dot_git):
+            # worktrees & submodules have a .git file pointing at the real
+            # git directory, "gitdir: <path>"
+            content = self._read(dot_git)
+            if content and content.startswith('gitdir:'):
+                self.path = os.path.join(worktree, content[len('gitdir:'):].strip())
+
+        if self.path is not None:
+            # linked worktrees keep their own HEAD, but share refs with the
+            # main repo, which commondir points at
+            commondir = self._read(os.path.join(self.path, 'commondir'))
+            if commondir:
+                self.common = os.path.join(self.path, commondir)
+            else:
+                self.common = self.path
+
+    @staticmethod
+    def _read(path):
+        """return the stripped content of a small file, or None"""
+        try:
+            with open(path) as fh:
+                return fh.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def exists(self):
+        return self.path is not None
+
+    def head(self):
+        """Return a (symref, sha1) tuple for HEAD
+
+        symref is the full name of the branch HEAD points to, or None if
+        HEAD is detached.  sha1 is None if it can't be read from disk.
+        """
+        if self.path is None:
+            return (None, None)
+
+        content = self._read(os.path.join(self.path, 'HEAD'))
+        if content is None:
+            return (None, None)
+
+        if content.startswith('ref:'):
+            symref = content[len('ref:'):].strip()
+            return (symref, self.resolve(symref))
+
+        if SHA1_RE.match(content):
+            return (None, content)
+
+        return (None, None)
+
+    def has_loose_object(self, sha1):
+        """Check for an unpacked object, a missing one may still be packed"""
+        if self.common is None:
+            return False
+        return os.path.exists(os.path.join(self.common, 'objects', sha1[:2], sha1[2:]))
+
+    def fetch_refspecs(self, remote='origin'):
+        """Return the fetch refspecs of remote, from the repo's config
+
+        Only the repo's own config file is read, refspecs set by includes
+        or in the global config aren't seen.
+        """
+        if self.common is None:
+            return []
+
+        content = self._read(os.path.join(self.common, 'config'))
+        refspecs = []
+        in_remote = False
+        for line in (content or '').splitlines():
+            line = line.strip()
+            section = _CONFIG_SECTION_RE.match(line)
+            if section:
+                # section names are case insensitive, subsections aren't
+                in_remote = section.group(1).lower() == 'remote' and section.group(2) == remote
+                line = line[section.end():].strip()
+            if in_remote:
+                fetch = _CONFIG_FETCH_RE.match(line)
+                if fetch:
+                    refspecs.append(fetch.group(1))
+        return refspecs
+
+    def packed_refs(self):
+        """Parse packed-refs, once, into {refname: [sha1, peeled sha1]}"""
+        if self._packed_refs is not None:
+            return self._packed_refs
+
+        self._packed_refs = {}
+        try:
+            with open(os.path.join(self.common, 'packed-refs')) as fh:
+                last = None
+                for line in fh:
+                    line = line.rstrip('\r\n')
+                    if line.startswith('#'):
+                        # header line listing the traits of the file, with
+                        # either trait every annotated tag has a ^ line
+                        traits = line.split()
+                        self._peeled = 'peeled' in traits or 'fully-peeled' in traits
+                    elif line.startswith('^') and last is not None:
+                        # the commit the tag on the previous line peels to
+                        last[1] = line[1:]
+                    elif line:
+                        sha1, refname = line.split(' ', 1)
+                        last = [sha1, None]
+                        self._packed_refs[refname] = last
+        except (IOError, OSError):
+            pass
+
+        return self._packed_refs
+
+    def resolve(self, refname):
+        """Return the sha1 a full refname points to, or None"""
+        if self.path is None:
+            return None
+
+        for _ in range(_MAX_SYMREF_DEPTH):
+            # pseudo refs such as HEAD live in the (per-worktree) git dir,
+            # everything under refs/ in the common dir
+            base = self.common if refname.startswith('refs/') else self.path
+            content = self._read(os.path.join(base, refname))
+            if content is None:
+                packed = self.packed_refs().get(refname)
+                return packed[0] if packed else None
+            if content.startswith('ref:'):
+                refname = content[len('ref:'):].strip()
+                continue
+            return content if SHA1_RE.match(content) else None
+
+        return None
+
+    def lookup(self, name):
+        """Resolve a short ref name the way git would
+
+        Returns a (refname, sha1, commit) tuple, or None if no ref by that
+        name exists.  commit is the sha1 of the commit the ref ultimately
+        points at, or None if that can't be told without reading objects -
+        which only happens for loose tags, as they may be annotated.
+        """
+        for rule in _REF_RULES:
+            refname = rule.format(name)
+            if not refname.startswith('refs/'):
+                continue
+
+            sha1 = self.resolve(refname)
+            if sha1 is None:
+                continue
+
+            if not refname.startswith('refs/tags/'):
+                return (refname, sha1, sha1)
+
+            packed = self.packed_refs().get(refname)
+            if packed is not None and packed[0] == sha1:
+                if packed[1] is not None:
+                    return (refname, sha1, packed[1])
+                if self._peeled:
+                    # annotated tags all have a peeled line, so this one
+                    # is a plain tag
+                    return (refname, sha1, sha1)
+
+            return (refname, sha1, None)
+
+        return None
@@ -0,0 +1,94 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import fnmatch
+import logging
+from gitshelf.ssh import SCP_LIKE_RE
+from gitshelf.utils import Url
+
+LOG = logging.getLogger(__name__)
+
+
+class BookIndex(object):
+    """ The books of a shelf, indexed by path, remote host & tag
+
+        Selectors pick books out of the index:
+            tag:NAME -- books with the tag NAME
+            host:NAME -- git books whose remote is on the host NAME
+            PATTERN -- books whose path, as given in the gitshelf YAML,
+                       matches the glob PATTERN
+
+        Keyword arguments:
+            books -- list of (path, Book) tuples, in shelf order
+    """
+
+    def __init__(self, books):
+        self.books = []
+        self.by_path = {}
+        self.by_host = {}
+        self.by_tag = {}
+        self._order = {}
+
+        for path, book in books:
+            self._order[id(book)] = len(self.books)
+            self.books.append((path, book))
+            self.by_path[path] = book
+            host = remote_host(book.git) if book.git is not None else None
+            if host is not None:
+                self.by_host.setdefault(host, []).append(book)
+            for tag in book.tags:
+                self.by_tag.setdefault(tag, []).append(book)
+
+    def match(self, selector):
+        """Return the list of books a selector picks, in shelf order"""
+        if selector.startswith('tag:'):
+            return list(self.by_tag.get(selector[len('tag:'):], []))
+        if selector.startswith('host:'):
+            return list(self.by_host.get(selector[len('host:'):].lower(), []))
+        if selector in self.by_path:
+            return [self.by_path[selector]]
+        return [book for path, book in self.books if fnmatch.fnmatchcase(path, selector)]
+
+    def select(self, only=None, exclude=None):
+        """Return the books picked by any of only, less those picked by any of exclude
+
+        Every book is picked if only is empty.  Books are returned in shelf
+        order.
+        """
+        if only:
+            selected = {}
+            for selector in only:
+                matched = self.match(selector)
+                if not matched:
+                    LOG.warning("WARNING --only {0} doesn't match any book".format(selector))
+                for book in matched:
+                    selected[id(book)] = book
+        else:
+            selected = dict((id(book), book) for path, book in self.books)
+
+        for selector in exclude or []:
+            for book in self.match(selector):
+                selected.pop(id(book), None)
+
+        return sorted(selected.values(), key=lambda book: self._order[id(book)])
+
+
+def remote_host(url):
+    """Return the lower cased host name of a git url, None for local paths"""
+    match = SCP_LIKE_RE.match(url)
+    if match and '://' not in url:
+        return match.group('host').lower()
+    hostname = Url(url).parts.hostname
+    return hostname.lower() if hostname else None
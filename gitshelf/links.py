@@ -0,0 +1,121 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import binascii
+import errno
+import logging
+import os
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+
+def ensure(path, target):
+    """Make path a symlink to target, returns what was done
+
+    Returns created, relinked or ok if the link was already right.  A link
+    pointing elsewhere is replaced by renaming a new link over it, so path
+    always exists, pointing at either the old or the new target.  Raises
+    OSError if path exists but isn't a link, or can't be changed.
+    """
+    parent = os.path.dirname(path.rstrip(os.sep))
+    _makedirs(parent)
+    return _ensure(parent, path, target)
+
+
+def reconcile(links):
+    """Make every (path, target) in links a symlink to target
+
+    Links are worked on a parent directory at a time, so each parent is
+    only created once.  Returns a list of (state, error) tuples in the
+    same order as links, state is as for ensure(), error is None unless
+    the link couldn't be put right, failures don't stop the other links.
+    """
+    results = [None] * len(links)
+
+    by_parent = OrderedDict()
+    for index, (path, target) in enumerate(links):
+        by_parent.setdefault(os.path.dirname(path.rstrip(os.sep)), []).append((index, path, target))
+
+    for parent, entries in by_parent.items():
+        try:
+            _makedirs(parent)
+        except OSError as e:
+            for index, path, target in entries:
+                results[index] = (None, "can't create {0}: {1}".format(parent, e.strerror))
+            continue
+
+        for index, path, target in entries:
+            try:
+                results[index] = (_ensure(parent, path, target), None)
+            except OSError as e:
+                results[index] = (None, '{0}: {1}'.format(path, e.strerror))
+
+    return results
+
+
+def _ensure(parent, path, target):
+    """ensure() for a path whose parent directory exists"""
+    try:
+        current = os.readlink(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            current = None
+        elif e.errno == errno.EINVAL:
+            # a file or directory, which we won't replace
+            raise OSError(errno.EEXIST, "exists and isn't a link")
+        else:
+            raise
+
+    if current == target:
+        LOG.debug("Link {0} already points to {1}".format(path, target))
+        return 'ok'
+
+    if current is None:
+        LOG.info("Creating link {0} to {1}".format(path, target))
+        # a relative target is stored as-is and so resolves relative to
+        # the link's parent
+        os.symlink(target, path)
+        return 'created'
+
+    LOG.info("Correcting link {0} from {1} to {2}".format(path, current, target))
+    _replace(parent, path, target)
+    return 'relinked'
+
+
+def _replace(parent, path, target):
+    """Atomically point the existing link path at target"""
+    # rename() replaces the old link in one step, removing it first would
+    # leave a moment with no link at all
+    temp = os.path.join(parent, '.{0}.{1}.tmp'.format(os.path.basename(path.rstrip(os.sep)),
+                                                      binascii.hexlify(os.urandom(4))))
+    os.symlink(target, temp)
+    try:
+        os.rename(temp, path)
+    except OSError:
+        os.remove(temp)
+        raise
+
+
+def _makedirs(path):
+    """os.makedirs(), that's happy if path exists already"""
+    if path == '':
+        return
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
@@ -0,0 +1,142 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import os
+from gitshelf import links
+from gitshelf.result import BookResult
+
+LOG = logging.getLogger(__name__)
+
+# the actions that change a book, in batches, every book in a batch is
+# worked on side by side.  Clones come first within their batch as they
+# take longest, checkouts don't wait for them to finish.
+BATCHES = (('clone', 'checkout'), ('link', 'relink'))
+
+
+class Step(object):
+    """ What needs doing to one book
+
+        Keyword arguments:
+            book -- the Book
+            action -- clone, checkout, link, relink, noop, skip (a relink
+                      held back by --skip-deletes) or unknown
+            reason -- why, e.g. "not at v1.2"
+            error -- why the book couldn't be inspected, action is None if set
+    """
+
+    __slots__ = ('book', 'action', 'reason', 'error')
+
+    def __init__(self, book, action=None, reason=None, error=None):
+        self.book = book
+        self.action = action
+        self.reason = reason
+        self.error = error
+
+    def result(self):
+        """A BookResult describing the step, for listing the plan"""
+        if self.error is not None:
+            return BookResult.failed(self.book, self.error)
+        state = 'ok' if self.action == 'noop' else 'pending'
+        return BookResult(self.book.path, kind=self.book.kind, state=state,
+                          action=self.action, reason=self.reason)
+
+
+class Plan(object):
+    """ The steps needed to bring every book on a shelf into line
+
+        A plan is made by looking at the books on disk only, without going
+        to the network, so a shelf that's mostly in line is checked cheaply
+        & only the books that need it are worked on.
+
+        Keyword arguments:
+            steps -- list of Step objects, in shelf order
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    @classmethod
+    def make(cls, engine, books, skip_deletes=False):
+        """Plan the books, up to engine.jobs at a time
+
+        With skip_deletes, links pointing elsewhere are left alone, as
+        relinking them removes the existing link.
+        """
+        steps = []
+        for book, value, error in engine.run(books, 'plan'):
+            if error is not None:
+                steps.append(Step(book, error=error))
+                continue
+            action, reason = value
+            if action == 'relink' and skip_deletes:
+                action, reason = 'skip', '{0}, not relinked with --skip-deletes'.format(reason)
+            steps.append(Step(book, action, reason))
+        return cls(steps)
+
+    def batches(self):
+        """A list of the books in each batch, ordered by action, as BATCHES"""
+        return [[step.book for action in actions for step in self.steps if step.action == action]
+                for actions in BATCHES]
+
+    def results(self):
+        """A BookResult describing each step"""
+        return [step.result() for step in self.steps]
+
+    def execute(self, engine):
+        """Carry out the plan, the git books in one batch, then the links
+
+        Returns a BookResult for every book, in shelf order.  Books with
+        nothing to do aren't touched, their result is made from the plan.
+        """
+        done = {}
+        git_books, link_books = self.batches()
+
+        if git_books:
+            LOG.info("Cloning or checking out {0} book(s)".format(len(git_books)))
+            for book, value, error in engine.run(git_books, 'create'):
+                done[id(book)] = BookResult.failed(book, error) if error is not None else value
+
+        # links are quick to make, they're done in one batch rather than
+        # a book at a time
+        if link_books:
+            LOG.info("Linking {0} book(s)".format(len(link_books)))
+            states = links.reconcile([(book.path, book.link) for book in link_books])
+            for book, (state, error) in zip(link_books, states):
+                if error is not None:
+                    LOG.error("ERROR create of book {0} failed: {1}".format(book.path, error))
+                    done[id(book)] = BookResult.failed(book, error)
+                else:
+                    done[id(book)] = BookResult(book.path, kind='link', state=state, target=book.link)
+
+        results = []
+        for step in self.steps:
+            book = step.book
+            if id(book) in done:
+                results.append(done[id(book)])
+            elif step.error is not None:
+                results.append(BookResult.failed(book, step.error))
+            elif step.action == 'noop' and book.kind == 'git':
+                results.append(BookResult(book.path, kind='git', state='ok', sha1=book._head()))
+            elif step.action == 'noop':
+                results.append(BookResult(book.path, kind='link', state='ok', target=book.link))
+            elif step.action == 'skip':
+                LOG.warning("WARNING book {0} {1}".format(book.path, step.reason))
+                results.append(BookResult(book.path, kind='link', state='wrong-link',
+                                          target=os.readlink(book.path)))
+            else:
+                LOG.error('Unknown book type: {0}'.format(book.path))
+                results.append(BookResult(book.path, state='unknown'))
+        return results
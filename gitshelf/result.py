@@ -0,0 +1,103 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# states that mean a book isn't as the shelf says it should be
+DRIFT_STATES = frozenset(['dirty', 'wrong-branch', 'missing', 'wrong-link', 'unknown', 'changed'])
+
+
+class BookResult(object):
+    """ The outcome of one operation on one book
+
+        Anything specific to the operation (ahead/behind counts, the sha1s
+        an update moved between, ...) is kept in details, and can be read
+        as an attribute like the common fields.
+
+        Keyword arguments:
+            path -- path of the book
+            kind -- 'git' or 'link', None if the book is neither
+            state -- what was found or done, e.g. ok, dirty, missing, created
+            sha1 -- the commit checked out in the book, if known
+            error -- why the operation failed, state is 'error' if set
+            details -- any other fields
+    """
+
+    __slots__ = ('path', 'kind', 'state', 'sha1', 'timings', 'error', 'details')
+
+    def __init__(self, path, kind=None, state=None, sha1=None, error=None, **details):
+        self.path = path
+        self.kind = kind
+        self.state = 'error' if error is not None else state
+        self.sha1 = sha1
+        self.error = error
+        self.timings = {}
+        self.details = details
+
+    def __getattr__(self, name):
+        # only called for names that aren't slots
+        if name == 'details':
+            raise AttributeError(name)
+        try:
+            return self.details[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return '<BookResult {0} {1}>'.format(self.path, self.state)
+
+    @classmethod
+    def failed(cls, book, error):
+        """The result of an operation on book that raised error"""
+        return cls(book.path, kind=book.kind, error=error)
+
+    @property
+    def drifted(self):
+        return self.state in DRIFT_STATES
+
+    def as_dict(self):
+        """A plain dict of the result, for JSON"""
+        result = dict(self.details)
+        result.update({'book': self.path,
+                       'type': self.kind,
+                       'state': self.state,
+                       'sha1': self.sha1,
+                       'timings': self.timings})
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+    @classmethod
+    def from_dict(cls, result):
+        """Rebuild a result from as_dict()"""
+        details = dict((str(key), value) for key, value in result.items()
+                       if key not in ('book', 'type', 'state', 'sha1', 'timings', 'error'))
+        rebuilt = cls(result['book'], kind=result.get('type'), state=result.get('state'),
+                      sha1=result.get('sha1'), error=result.get('error'), **details)
+        rebuilt.timings = result.get('timings') or {}
+        return rebuilt
+
+
+def exit_status(results):
+    """2 if any operation failed, 1 if any book has drifted, otherwise 0"""
+    status = 0
+    for result in results:
+        if result.state == 'error':
+            return 2
+        if result.drifted:
+            status = 1
+    return status
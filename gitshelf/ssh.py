@@ -0,0 +1,215 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import math
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from gitshelf.engine import remaining
+from gitshelf.exceptions import BookTimeout, Cancelled
+from gitshelf.utils import Url
+
+LOG = logging.getLogger(__name__)
+
+SSH_SCHEMES = ('ssh', 'git+ssh', 'ssh+git')
+
+# git's scp-like syntax, [user@]host:path, see git-clone(1)
+SCP_LIKE_RE = re.compile(r'^(?:(?P<user>[^@/]+)@)?(?P<host>[^:/]+):(?!//)')
+
+# how often the master is checked on, so the book's time limit & ^C are seen
+_POLL = 0.05
+
+
+class SshMultiplexer(object):
+    """ Share one SSH connection per host between every git command of a run
+
+        While started, git is told (via GIT_SSH_COMMAND) to use an OpenSSH
+        control master per host.  The master is opened by the first book to
+        want a host, before any git command runs against it, so only one
+        SSH handshake is made per host.  Opening & waiting for the master
+        both keep to the book's time limit.  Books hold a per-host slot around
+        their network commands, limiting how many run against one host at
+        once.
+
+        Keyword arguments:
+            per_host -- how many git commands may use a host at once, 0 for
+                        no limit
+            persist -- seconds an idle master connection stays open
+    """
+
+    def __init__(self, per_host=4, persist=60):
+        self.per_host = per_host
+        self.persist = persist
+        self.control_dir = None
+        self._ssh_command = None
+        self._saved_env = None
+        self._slots = {}
+        self._masters = {}
+        self._opened = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        """Return a (user, host, port) tuple for an ssh url, None for other urls"""
+        match = SCP_LIKE_RE.match(url)
+        if match and '://' not in url:
+            return (match.group('user'), match.group('host'), None)
+
+        parts = Url(url).parts
+        if parts.scheme in SSH_SCHEMES and parts.hostname:
+            return (parts.username, parts.hostname, parts.port)
+
+        return None
+
+    def start(self):
+        """Point git's ssh at the shared control masters"""
+        if 'GIT_SSH' in os.environ and 'GIT_SSH_COMMAND' not in os.environ:
+            # GIT_SSH names a program, which may not take OpenSSH options
+            LOG.debug('GIT_SSH is set, not sharing ssh connections')
+            return
+
+        # keep the path short, control sockets must fit in sun_path
+        self.control_dir = tempfile.mkdtemp(prefix='gitshelf-ssh-')
+        self._ssh_command = os.environ.get('GIT_SSH_COMMAND', 'ssh')
+        self._saved_env = os.environ.get('GIT_SSH_COMMAND')
+        # auto, so git still works if the master couldn't be opened
+        os.environ['GIT_SSH_COMMAND'] = ('{0} -o ControlMaster=auto -o ControlPath={1}/%C '
+                                         '-o ControlPersist={2}').format(self._ssh_command,
+                                                                         self.control_dir,
+                                                                         self.persist)
+        LOG.debug('GIT_SSH_COMMAND is {0}'.format(os.environ['GIT_SSH_COMMAND']))
+
+    @contextmanager
+    def slot(self, url):
+        """Hold one of the slots for url's host while running git against it"""
+        host = self.host(url)
+        if host is None:
+            yield
+            return
+
+        with self._lock:
+            first = host not in self._slots
+            if first:
+                self._slots[host] = threading.BoundedSemaphore(self.per_host) if self.per_host else None
+                self._masters[host] = threading.Event()
+            slot = self._slots[host]
+            master = self._masters[host]
+
+        # everyone else waits for the master, rather than each racing to
+        # make their own connection to the host
+        if first:
+            try:
+                self._start_master(host)
+            finally:
+                master.set()
+        else:
+            while not master.is_set():
+                # raises BookTimeout or Cancelled for us
+                timeout = remaining()
+                master.wait(_POLL if timeout is None else min(timeout, _POLL))
+
+        if slot is None:
+            yield
+        else:
+            with slot:
+                yield
+
+    @staticmethod
+    def _host_args(user, port):
+        """ssh options for the user & port of a (user, host, port) tuple"""
+        args = []
+        if user:
+            args += ['-l', user]
+        if port:
+            args += ['-p', str(port)]
+        return args
+
+    def _start_master(self, host):
+        """Open the shared connection to host, in the background"""
+        if self.control_dir is None:
+            return
+
+        user, hostname, port = host
+        args = ['-o', 'ControlMaster=yes',
+                '-o', 'ControlPath={0}/%C'.format(self.control_dir),
+                '-o', 'ControlPersist={0}'.format(self.persist),
+                '-N', '-f'] + self._host_args(user, port) + [hostname]
+        timeout = remaining()
+        if timeout is not None:
+            args = ['-o', 'ConnectTimeout={0}'.format(int(math.ceil(timeout)))] + args
+        LOG.debug('Opening a shared ssh connection to {0}'.format(hostname))
+        # the backgrounded master keeps its stdio open, so it's given
+        # /dev/null rather than pipes, which would be waited on
+        with open(os.devnull, 'r+') as devnull:
+            try:
+                process = subprocess.Popen(shlex.split(self._ssh_command) + args,
+                                           stdin=devnull, stdout=devnull, stderr=devnull)
+            except OSError as e:
+                LOG.debug("Couldn't open a shared ssh connection to {0}: {1}".format(hostname, e))
+                return
+
+            # ConnectTimeout doesn't cover the handshake, or a wrapper in
+            # GIT_SSH_COMMAND, so ssh is killed once the book is out of time
+            try:
+                while process.poll() is None:
+                    remaining()
+                    time.sleep(_POLL)
+            except (BookTimeout, Cancelled):
+                process.kill()
+                process.wait()
+                LOG.debug('Gave up opening a shared ssh connection to {0}'.format(hostname))
+                raise
+
+        if process.returncode != 0:
+            # git's ssh will connect for itself
+            LOG.debug("Couldn't open a shared ssh connection to {0}: {1}".format(hostname, process.returncode))
+            return
+
+        # remember the masters opened, so close() can stop them
+        with self._lock:
+            self._opened.add(host)
+
+    def close(self):
+        """Shut down the master connections & restore git's environment"""
+        if self.control_dir is None:
+            return
+
+        # the same ssh as opened the masters, a wrapper may pick the config
+        command = shlex.split(self._ssh_command)
+        with open(os.devnull, 'r+') as devnull:
+            for user, host, port in self._opened:
+                args = ['-o', 'ControlPath={0}/%C'.format(self.control_dir), '-O', 'exit'] + \
+                    self._host_args(user, port)
+                try:
+                    # fails if there's no master running for this host, it
+                    # may have timed out
+                    subprocess.call(command + args + [host], stdin=devnull, stdout=devnull, stderr=devnull)
+                except OSError:
+                    break
+
+        if self._saved_env is None:
+            os.environ.pop('GIT_SSH_COMMAND', None)
+        else:
+            os.environ['GIT_SSH_COMMAND'] = self._saved_env
+
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
@@ -0,0 +1,84 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import hashlib
+import json
+import logging
+import os
+import threading
+from gitshelf.result import BookResult
+from gitshelf.utils import atomic_write, cache_home
+
+LOG = logging.getLogger(__name__)
+
+# bump when the records or fingerprints change, older state files are ignored
+STATE_VERSION = 3
+
+
+class StateFile(object):
+    """ The last known status of each book of a shelf, kept between runs
+
+        Each book's status result is stored with the fingerprint of the book
+        it was taken from, a result is only handed back while the book's
+        fingerprint still matches.
+
+        Keyword arguments:
+            path -- JSON file holding the state, created by save()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.books = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        try:
+            with open(self.path) as fh:
+                state = json.load(fh)
+            if state.get('version') == STATE_VERSION:
+                self.books = state['books']
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            LOG.debug("Not using the state in {0}: {1}".format(self.path, e))
+
+    @staticmethod
+    def default_path(config_file, fakeroot=None):
+        """Where the state of a shelf is kept unless told otherwise, one file per shelf"""
+        key = json.dumps([os.path.abspath(config_file), fakeroot])
+        return os.path.join(cache_home(), 'state', '{0}.json'.format(hashlib.sha1(key).hexdigest()))
+
+    def get(self, book, fingerprint):
+        """Return the last BookResult of a book, None if it has changed since"""
+        with self._lock:
+            entry = self.books.get(book)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return BookResult.from_dict(entry['result'])
+
+    def put(self, book, fingerprint, result):
+        with self._lock:
+            self.books[book] = {'fingerprint': fingerprint, 'result': result.as_dict()}
+            self._dirty = True
+
+    def save(self):
+        """Write the state out, if anything has changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with atomic_write(self.path) as fh:
+                json.dump({'version': STATE_VERSION, 'books': self.books}, fh, separators=(',', ':'))
+            self._dirty = False
@@ -0,0 +1,75 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import unittest2
+from gitshelf.book import _parse_porcelain_v2
+
+OID = 'a' * 40
+
+# `git status --porcelain=v2 --branch`, see git-status(1)
+PORCELAIN_V2 = '\n'.join([
+    '# branch.oid {0}'.format(OID),
+    '# branch.head master',
+    '# branch.upstream origin/master',
+    '# branch.ab +2 -3',
+    '1 .M N... 100644 100644 100644 {0} {0} file one.txt'.format(OID),
+    '1 A. N... 000000 100644 100644 {0} {0} added.txt'.format('0' * 40),
+    '1 MM N... 100644 100644 100644 {0} {0} both.txt'.format(OID),
+    '2 R. N... 100644 100644 100644 {0} {0} R100 new name.txt\told name.txt'.format(OID),
+    'u UU N... 100644 100644 100644 100644 {0} {0} {0} conflict.txt'.format(OID),
+    '? untracked file.txt',
+    '! ignored.txt',
+    ''])
+
+
+class ParsePorcelainV2TestCase(unittest2.TestCase):
+    """ _parse_porcelain_v2 against fixed git status output """
+
+    def test_branch_headers(self):
+        status, changes = _parse_porcelain_v2(PORCELAIN_V2)
+        self.assertEqual(status['sha1'], OID)
+        self.assertEqual(status['head'], 'master')
+        self.assertEqual(status['upstream'], 'origin/master')
+        self.assertEqual((status['ahead'], status['behind']), (2, 3))
+
+    def test_counts(self):
+        status, changes = _parse_porcelain_v2(PORCELAIN_V2)
+        self.assertEqual(status['staged'], 3)
+        self.assertEqual(status['modified'], 2)
+        self.assertEqual(status['unmerged'], 1)
+        self.assertEqual(status['untracked'], 1)
+
+    def test_changes(self):
+        status, changes = _parse_porcelain_v2(PORCELAIN_V2)
+        self.assertEqual(changes, ['.M file one.txt',
+                                   'A. added.txt',
+                                   'MM both.txt',
+                                   'R. new name.txt\told name.txt',
+                                   'UU conflict.txt',
+                                   '?? untracked file.txt'])
+
+    def test_initial_detached_without_upstream(self):
+        status, changes = _parse_porcelain_v2('# branch.oid (initial)\n# branch.head (detached)\n')
+        self.assertIsNone(status['sha1'])
+        self.assertIsNone(status['head'])
+        self.assertIsNone(status['upstream'])
+        self.assertEqual((status['ahead'], status['behind']), (0, 0))
+        self.assertEqual(changes, [])
+
+    def test_clean(self):
+        status, changes = _parse_porcelain_v2('# branch.oid {0}\n# branch.head master\n'.format(OID))
+        self.assertEqual([status[count] for count in ('staged', 'modified', 'unmerged', 'untracked')],
+                         [0, 0, 0, 0])
+        self.assertEqual(changes, [])
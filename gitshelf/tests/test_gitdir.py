@@ -0,0 +1,174 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import shutil
+import tempfile
+import unittest2
+from gitshelf.gitdir import GitDir
+
+COMMIT = '1' * 40
+OTHER = '2' * 40
+TAG = '3' * 40
+
+
+class GitDirTestCase(unittest2.TestCase):
+    """ GitDir against .git directories laid out by hand, as git writes them """
+
+    def setUp(self):
+        super(GitDirTestCase, self).setUp()
+        self.root = tempfile.mkdtemp(prefix='gitshelf-test-')
+        self.worktree = os.path.join(self.root, 'repo')
+        self.git = os.path.join(self.worktree, '.git')
+        os.makedirs(os.path.join(self.git, 'refs', 'heads'))
+        os.makedirs(os.path.join(self.git, 'refs', 'tags'))
+        self.write('HEAD', 'ref: refs/heads/master\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(GitDirTestCase, self).tearDown()
+
+    def write(self, name, content, base=None):
+        path = os.path.join(base or self.git, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def packed_refs(self, *lines, **kwargs):
+        header = kwargs.get('header', '# pack-refs with: peeled fully-peeled sorted ')
+        self.write('packed-refs', '\n'.join(([header] if header else []) + list(lines)) + '\n')
+
+    def test_loose_branch(self):
+        self.write('refs/heads/master', COMMIT + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('master'), ('refs/heads/master', COMMIT, COMMIT))
+
+    def test_packed_branch(self):
+        self.packed_refs('{0} refs/heads/master'.format(COMMIT))
+        self.assertEqual(GitDir(self.worktree).lookup('master'), ('refs/heads/master', COMMIT, COMMIT))
+
+    def test_loose_ref_overrides_packed(self):
+        self.packed_refs('{0} refs/heads/master'.format(COMMIT))
+        self.write('refs/heads/master', OTHER + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('master'), ('refs/heads/master', OTHER, OTHER))
+
+    def test_tag_before_branch(self):
+        # gitrevisions(7) tries refs/tags/<name> before refs/heads/<name>
+        self.write('refs/heads/v1', COMMIT + '\n')
+        self.write('refs/tags/v1', OTHER + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('v1')[0], 'refs/tags/v1')
+
+    def test_remote_branch(self):
+        self.write('refs/remotes/origin/dev', COMMIT + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('origin/dev'), ('refs/remotes/origin/dev', COMMIT, COMMIT))
+
+    def test_missing_ref(self):
+        self.assertIsNone(GitDir(self.worktree).lookup('nope'))
+
+    def test_packed_annotated_tag(self):
+        self.packed_refs('{0} refs/tags/v1'.format(TAG), '^{0}'.format(COMMIT))
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', TAG, COMMIT))
+
+    def test_packed_lightweight_tag_peeled(self):
+        # with the peeled trait, a tag without a ^ line isn't annotated
+        self.packed_refs('{0} refs/tags/v1'.format(COMMIT))
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', COMMIT, COMMIT))
+
+    def test_packed_tag_without_peeled_trait(self):
+        # an old packed-refs can't say whether a tag is annotated
+        self.packed_refs('{0} refs/tags/v1'.format(COMMIT), header=None)
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', COMMIT, None))
+
+    def test_packed_tag_without_peeled_trait_header(self):
+        self.packed_refs('{0} refs/tags/v1'.format(COMMIT), header='# pack-refs with: sorted ')
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', COMMIT, None))
+
+    def test_loose_tag(self):
+        # a loose tag may be annotated, which only its object can tell
+        self.write('refs/tags/v1', TAG + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', TAG, None))
+
+    def test_loose_tag_overrides_packed_peel(self):
+        self.packed_refs('{0} refs/tags/v1'.format(TAG), '^{0}'.format(COMMIT))
+        self.write('refs/tags/v1', OTHER + '\n')
+        self.assertEqual(GitDir(self.worktree).lookup('v1'), ('refs/tags/v1', OTHER, None))
+
+    def test_head_on_branch(self):
+        self.write('refs/heads/master', COMMIT + '\n')
+        self.assertEqual(GitDir(self.worktree).head(), ('refs/heads/master', COMMIT))
+
+    def test_head_on_packed_branch(self):
+        self.packed_refs('{0} refs/heads/master'.format(COMMIT))
+        self.assertEqual(GitDir(self.worktree).head(), ('refs/heads/master', COMMIT))
+
+    def test_head_on_unborn_branch(self):
+        self.assertEqual(GitDir(self.worktree).head(), ('refs/heads/master', None))
+
+    def test_detached_head(self):
+        self.write('HEAD', COMMIT + '\n')
+        self.assertEqual(GitDir(self.worktree).head(), (None, COMMIT))
+
+    def test_symref_chain(self):
+        self.write('refs/heads/master', COMMIT + '\n')
+        self.write('refs/heads/alias', 'ref: refs/heads/master\n')
+        self.assertEqual(GitDir(self.worktree).lookup('alias'), ('refs/heads/alias', COMMIT, COMMIT))
+
+    def test_symref_loop(self):
+        self.write('refs/heads/a', 'ref: refs/heads/b\n')
+        self.write('refs/heads/b', 'ref: refs/heads/a\n')
+        self.assertIsNone(GitDir(self.worktree).resolve('refs/heads/a'))
+
+    def test_worktree_git_file(self):
+        # a linked worktree has its own HEAD, & shares the main repo's refs
+        self.write('refs/heads/master', COMMIT + '\n')
+        self.packed_refs('{0} refs/heads/feature'.format(OTHER))
+        linked = os.path.join(self.git, 'worktrees', 'linked')
+        self.write('HEAD', 'ref: refs/heads/feature\n', base=linked)
+        self.write('commondir', '../..\n', base=linked)
+        worktree = os.path.join(self.root, 'linked')
+        self.write('.git', 'gitdir: {0}\n'.format(os.path.relpath(linked, worktree)), base=worktree)
+
+        gitdir = GitDir(worktree)
+        self.assertTrue(gitdir.exists())
+        self.assertEqual(os.path.realpath(gitdir.common), os.path.realpath(self.git))
+        self.assertEqual(gitdir.head(), ('refs/heads/feature', OTHER))
+        self.assertEqual(gitdir.lookup('master'), ('refs/heads/master', COMMIT, COMMIT))
+
+    def test_not_a_repo(self):
+        gitdir = GitDir(self.root)
+        self.assertFalse(gitdir.exists())
+        self.assertEqual(gitdir.head(), (None, None))
+        self.assertIsNone(gitdir.lookup('master'))
+
+    def test_loose_object(self):
+        self.write(os.path.join('objects', COMMIT[:2], COMMIT[2:]), '')
+        gitdir = GitDir(self.worktree)
+        self.assertTrue(gitdir.has_loose_object(COMMIT))
+        self.assertFalse(gitdir.has_loose_object(OTHER))
+
+    def test_fetch_refspecs(self):
+        self.write('config', '[core]\n'
+                             '\tbare = false\n'
+                             '[remote "upstream"]\n'
+                             '\tfetch = +refs/heads/*:refs/remotes/upstream/*\n'
+                             '[Remote "origin"]\n'
+                             '\turl = file:///tmp/origin.git\n'
+                             '\tfetch = +refs/heads/master:refs/remotes/origin/master\n'
+                             '\tFetch = +refs/tags/*:refs/tags/*\n')
+        self.assertEqual(GitDir(self.worktree).fetch_refspecs(),
+                         ['+refs/heads/master:refs/remotes/origin/master', '+refs/tags/*:refs/tags/*'])
+
+    def test_fetch_refspecs_no_config(self):
+        self.assertEqual(GitDir(self.worktree).fetch_refspecs(), [])
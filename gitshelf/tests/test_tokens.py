@@ -0,0 +1,78 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import unittest2
+from gitshelf.tokens import Template, environment_tokens
+
+CONFIG = {
+    'environments': {
+        'dev': {'tokens': {'branch': 'develop', 'host': 'git.dev'}},
+        'prod': {'tokens': {'branch': 'master'}},
+    },
+    'books': [
+        {'book': 'books/{branch}', 'git': 'ssh://{host}/repo.git', 'branch': '{branch}', 'depth': 1},
+        {'book': 'static', 'link': '{missing}', 'tags': ['{branch}', 'literal {not a token}']},
+    ],
+}
+
+
+class TemplateTestCase(unittest2.TestCase):
+    """ Template against a fixed config """
+
+    def test_tokens(self):
+        self.assertEqual(Template(CONFIG).tokens, set(['branch', 'host', 'missing']))
+
+    def test_render(self):
+        config, unresolved = Template(CONFIG).render({'branch': 'dev', 'host': 'h', 'missing': 'm'})
+        self.assertEqual(config['books'][0], {'book': 'books/dev', 'git': 'ssh://h/repo.git',
+                                              'branch': 'dev', 'depth': 1})
+        self.assertEqual(config['books'][1]['tags'], ['dev', 'literal {not a token}'])
+        self.assertEqual(unresolved, [])
+
+    def test_unresolved(self):
+        config, unresolved = Template(CONFIG).render({'branch': 'dev'})
+        self.assertEqual(config['books'][0]['git'], 'ssh:///repo.git')
+        self.assertEqual(config['books'][1]['link'], '')
+        self.assertEqual(unresolved, ['host', 'missing'])
+
+    def test_environments_untouched(self):
+        config, unresolved = Template(CONFIG).render({})
+        self.assertIs(config['environments'], CONFIG['environments'])
+
+    def test_render_environments(self):
+        rendered = Template(CONFIG).render_environments(['missing=m'])
+        self.assertEqual(sorted(rendered), ['dev', 'prod'])
+        self.assertEqual(rendered['dev'][0]['books'][0]['git'], 'ssh://git.dev/repo.git')
+        self.assertEqual(rendered['dev'][1], [])
+        self.assertEqual(rendered['prod'][0]['books'][0]['book'], 'books/master')
+        self.assertEqual(rendered['prod'][1], ['host'])
+
+
+class EnvironmentTokensTestCase(unittest2.TestCase):
+    """ environment_tokens & --token overrides """
+
+    def test_environment(self):
+        self.assertEqual(environment_tokens(CONFIG, 'dev'), {'branch': 'develop', 'host': 'git.dev'})
+
+    def test_unknown_environment(self):
+        self.assertEqual(environment_tokens(CONFIG, 'nope'), {})
+
+    def test_overrides(self):
+        tokens = environment_tokens(CONFIG, 'dev', ['branch=feature', 'url=a=b'])
+        self.assertEqual(tokens, {'branch': 'feature', 'host': 'git.dev', 'url': 'a=b'})
+
+    def test_overrides_leave_config_alone(self):
+        environment_tokens(CONFIG, 'prod', ['branch=feature'])
+        self.assertEqual(CONFIG['environments']['prod']['tokens'], {'branch': 'master'})
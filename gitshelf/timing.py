@@ -0,0 +1,163 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+# the Profiler recording this run, None when not profiling
+_active = None
+
+# the book & operation being worked on, per thread
+_current = threading.local()
+
+
+class Profiler(object):
+    """ Record where the time of a run goes, per book, operation & git command
+
+        While started, the engine reports each book operation it runs, and
+        every git command run for a book is timed & attributed to the book
+        & operation it was run for.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.ended = None
+        self.operations = []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        global _active
+        self.started = time.time()
+        _active = self
+
+    def stop(self):
+        global _active
+        self.ended = time.time()
+        _active = None
+
+    def record_operation(self, book, action, started, ended):
+        with self._lock:
+            self.operations.append((book, action, threading.current_thread().ident, started, ended))
+
+    def record_call(self, book, action, command, started, ended):
+        with self._lock:
+            self.calls.append((book, action, command, threading.current_thread().ident, started, ended))
+
+    def report(self, top=10):
+        """Return the profile as a list of lines of text
+
+        Python time is the time spent on each book outside of git, summed
+        over the books, so with --jobs it can exceed the wall time.
+        """
+        wall = (self.ended or time.time()) - self.started
+        book_time = defaultdict(float)
+        book_git = defaultdict(float)
+        book_calls = defaultdict(int)
+        for book, action, thread, started, ended in self.operations:
+            book_time[book] += ended - started
+
+        commands = defaultdict(lambda: [0, 0.0])
+        for book, action, command, thread, started, ended in self.calls:
+            commands[command][0] += 1
+            commands[command][1] += ended - started
+            book_git[book] += ended - started
+            book_calls[book] += 1
+
+        git_time = sum(book_git.values())
+        op_time = sum(book_time.values())
+        lines = ['Profile: {0} books in {1:.3f}s'.format(len(book_time), wall),
+                 '  git: {0} commands, {1:.3f}s'.format(len(self.calls), git_time),
+                 '  python: {0:.3f}s'.format(max(op_time - git_time, 0.0)),
+                 '  git commands:']
+        for command, (count, seconds) in sorted(commands.items(), key=lambda item: -item[1][1]):
+            lines.append('    {0:>8.3f}s {1:>6} {2}'.format(seconds, count, command))
+
+        lines.append('  slowest books:')
+        for book, seconds in sorted(book_time.items(), key=lambda item: -item[1])[:top]:
+            lines.append('    {0:>8.3f}s {1} ({3:.3f}s in {2} git command(s))'.format(
+                seconds, book, book_calls[book], book_git[book]))
+        return lines
+
+    def write_trace(self, path):
+        """Write the profile as a Chrome trace, for chrome://tracing or Perfetto"""
+        pid = os.getpid()
+
+        def _event(name, category, thread, started, ended, args):
+            return {'name': name,
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': int((started - self.started) * 1e6),
+                    'dur': int((ended - started) * 1e6),
+                    'pid': pid,
+                    'tid': thread,
+                    'args': args}
+
+        events = [_event('{0} {1}'.format(action, book), 'book', thread, started, ended,
+                         {'book': book, 'operation': action})
+                  for book, action, thread, started, ended in self.operations]
+        events += [_event('git {0}'.format(command), 'git', thread, started, ended,
+                          {'book': book, 'operation': action})
+                   for book, action, command, thread, started, ended in self.calls]
+
+        with open(path, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+
+@contextmanager
+def operation(book, action):
+    """Attribute the git commands run in this thread to book & action, while profiling"""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+
+    _current.book = book
+    _current.action = action
+    started = time.time()
+    try:
+        yield
+    finally:
+        profiler.record_operation(book, action, started, time.time())
+        _current.book = None
+        _current.action = None
+
+
+@contextmanager
+def timed(command, book=None):
+    """Time a git command, while profiling
+
+    The command is attributed to book, or failing that to the book being
+    worked on by this thread.
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        profiler.record_call(book or getattr(_current, 'book', None),
+                             getattr(_current, 'action', None),
+                             command, started, time.time())
@@ -0,0 +1,121 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import logging
+import re
+
+LOG = logging.getLogger(__name__)
+
+# tokens are {} wrapped names from the environment section, anything else in
+# braces is left alone
+TOKEN_RE = re.compile(r'\{(\w+)\}')
+
+
+class Template(object):
+    """ A parsed gitshelf config, compiled for token substitution
+
+        Every string in the config that holds a token is split into its
+        literal text & token names once, so the config can be rendered for
+        any number of environments without searching it again.  Only string
+        values are substituted, never mapping keys, and the environments
+        section is passed through untouched.
+
+        Keyword arguments:
+            config -- the parsed config, as loaded from the YAML
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.tokens = set()
+        self._compiled = dict((key, self._compile(value)) for key, value in config.items()
+                              if key != 'environments')
+
+    def _compile(self, node):
+        if isinstance(node, dict):
+            return dict((key, self._compile(value)) for key, value in node.items())
+        if isinstance(node, list):
+            return [self._compile(item) for item in node]
+        if isinstance(node, basestring) and TOKEN_RE.search(node):
+            # split gives literal, name, literal, name, ..., literal
+            parts = TOKEN_RE.split(node)
+            self.tokens.update(parts[1::2])
+            return _Parts(parts)
+        return node
+
+    def render(self, tokens):
+        """Substitute tokens into the config
+
+        Returns a (config, unresolved) tuple, unresolved is the sorted list of
+        token names that tokens has no value for, which are replaced with
+        nothing.
+        """
+        unresolved = set()
+
+        def _render(node):
+            if isinstance(node, dict):
+                return dict((key, _render(value)) for key, value in node.items())
+            if isinstance(node, _Parts):
+                out = []
+                for index, part in enumerate(node):
+                    if index % 2 == 0:
+                        out.append(part)
+                    elif part in tokens:
+                        out.append(unicode(tokens[part]))
+                    else:
+                        unresolved.add(part)
+                return ''.join(out)
+            if isinstance(node, list):
+                return [_render(item) for item in node]
+            return node
+
+        config = _render(self._compiled)
+        if 'environments' in self.config:
+            config['environments'] = self.config['environments']
+        return (config, sorted(unresolved))
+
+    def render_environments(self, overrides=None):
+        """Render the config for every environment it defines
+
+        Returns a dict of environment name to (config, unresolved) tuples.
+        """
+        rendered = {}
+        for environment in self.config.get('environments') or {}:
+            rendered[environment] = self.render(environment_tokens(self.config, environment, overrides))
+        return rendered
+
+
+class _Parts(list):
+    """a compiled string, alternating literal text & token names"""
+
+
+def environment_tokens(config, environment, overrides=None):
+    """Return the tokens for an environment, with any overrides applied
+
+    overrides is a list of name=value strings, as passed to --token.
+    """
+    environments = config.get('environments') or {}
+    tokens = dict((environments.get(environment) or {}).get('tokens') or {})
+    LOG.debug('Tokens: {0}'.format(tokens))
+
+    # overwrite the tokens loaded from the file with any passed on the
+    # command line
+    if overrides:
+        LOG.debug("Tokens have been passed on the command line: {0}".format(overrides))
+        for override in overrides:
+            name, _, value = override.partition('=')
+            tokens[name] = value
+        LOG.debug('Tokens: {0}'.format(tokens))
+
+    return tokens
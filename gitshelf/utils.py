@@ -14,6 +14,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import tempfile
+from contextlib import contextmanager
 from urlparse import urlparse, parse_qsl
 from urllib import unquote_plus
 
@@ -80,6 +83,16 @@ class Url(object):
     def __eq__(self, other):
         return self.parts == other.parts
 
+    def normalized(self):
+        '''Return the url as a canonical string, so that urls that compare
+        equal normalize to the same string.'''
+        parts = self.parts
+        query = '&'.join('{0}={1}'.format(k, v) for k, v in sorted(parts.query))
+        return parts._replace(scheme=parts.scheme.lower(),
+                              netloc=parts.netloc.lower(),
+                              path=parts.path.rstrip('/'),
+                              query=query).geturl()
+
     def __hash__(self):
         return hash(self.parts)
 
@@ -93,3 +106,42 @@ class NestedDict(dict):
         if key in self:
             return self.get(key)
         return self.setdefault(key, NestedDict())
+
+
+def parse_size(size):
+    """Parse a size such as 512M or 10G into a number of bytes"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def cache_home():
+    """Directory for gitshelf's caches, following the XDG base directory spec"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'gitshelf')
+
+
+@contextmanager
+def atomic_write(path):
+    """Open a temporary file alongside path, renamed over path on success
+
+    Readers of path never see a partially written file, and it's left alone
+    if writing fails.
+    """
+    fh = tempfile.NamedTemporaryFile(mode='w',
+                                     dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix='.{0}.'.format(os.path.basename(path)),
+                                     delete=False)
+    try:
+        with fh:
+            yield fh
+        # temporary files are private, give the file the usual mode
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(fh.name, 0o666 & ~umask)
+        os.rename(fh.name, path)
+    except BaseException:
+        os.remove(fh.name)
+        raise
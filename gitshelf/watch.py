@@ -0,0 +1,273 @@
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import json
+import logging
+import os
+import SocketServer
+import threading
+import time
+from gitshelf.engine import Engine
+from gitshelf.gitdir import GitDir
+from gitshelf.result import BookResult
+from gitshelf.utils import atomic_write
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+LOG = logging.getLogger(__name__)
+
+# changes arrive in bursts (a checkout touches many files), wait this long
+# for a burst to finish before checking the books it touched
+SETTLE = 0.5
+
+
+class Watcher(object):
+    """ Keep the status of a shelf up to date as its books change
+
+        With pyinotify installed, the working tree & .git directory of each
+        repo, and the parent directory of each link, are watched, & only
+        books with changes are looked at again.  Without it (or with poll)
+        every book is fingerprinted each interval instead, & only re-checked
+        with git when its fingerprint changes.  The fingerprint doesn't see
+        files edited in place until git next updates the index, so polling
+        is slower to notice those.
+
+        The status of every book is published to a JSON drift file and/or
+        served to anything connecting to a unix socket.
+
+        Keyword arguments:
+            books -- list of Book objects to watch
+            engine -- Engine to check books with
+            interval -- seconds between polls, or between attempts to watch
+                        books that can't be watched yet (e.g. missing ones)
+            poll -- poll even if pyinotify is available
+            drift_file -- path to write the status of the shelf to
+            socket_path -- path of a unix socket to serve the status on
+    """
+
+    def __init__(self, books, engine=None, interval=10, poll=False, drift_file=None, socket_path=None):
+        self.books = books
+        self.engine = engine or Engine()
+        self.interval = interval
+        self.poll = poll or pyinotify is None
+        self.drift_file = drift_file
+        self.socket_path = socket_path
+        self.results = {}
+        self.updated = None
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._roots = {}
+        self._wds = {}
+        self._link_parents = {}
+        self._server = None
+
+    def snapshot(self):
+        """Return the status of the shelf, as published"""
+        with self._lock:
+            results = [self.results[book.path] for book in self.books if book.path in self.results]
+            return {'updated': self.updated,
+                    'drift': [result.path for result in results if result.state != 'ok'],
+                    'books': [result.as_dict() for result in results]}
+
+    def check(self, books, force=False):
+        """Re-check the books whose fingerprints have changed, & publish the results
+
+        With force, every book is re-checked, e.g. when inotify has already
+        said they've changed.
+        """
+        changed = []
+        for book in books:
+            fingerprint = book.fingerprint()
+            if not force and book.path in self.results and fingerprint == self._fingerprints.get(book.path):
+                continue
+            # remember the fingerprint from before the check, so a change
+            # made while it runs is picked up next time
+            self._fingerprints[book.path] = fingerprint
+            changed.append(book)
+
+        if not changed:
+            return
+
+        results = self.engine.run(changed, 'status')
+        with self._lock:
+            for book, result, error in results:
+                if error is not None:
+                    result = BookResult.failed(book, error)
+                    # try again next time, the failure may be transient
+                    self._fingerprints.pop(book.path, None)
+                last = self.results.get(book.path)
+                if last is not None and last.state != result.state:
+                    LOG.info("# book {0} was {1}, is now {2}".format(book.path, last.state, result.state))
+                self.results[book.path] = result
+            self.updated = time.time()
+
+        self.publish()
+
+    def publish(self):
+        if self.drift_file is not None:
+            with atomic_write(self.drift_file) as fh:
+                json.dump(self.snapshot(), fh, indent=2, sort_keys=True, separators=(',', ': '))
+                fh.write('\n')
+
+    def run(self):
+        """Check every book, then watch them until interrupted"""
+        self.check(self.books)
+        self._serve()
+        try:
+            if self.poll:
+                LOG.info("# polling {0} books every {1}s".format(len(self.books), self.interval))
+                while True:
+                    time.sleep(self.interval)
+                    self.check(self.books)
+            else:
+                self._watch()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def _serve(self):
+        """Serve snapshots on the unix socket, from a background thread"""
+        if self.socket_path is None:
+            return
+
+        if os.path.exists(self.socket_path):
+            # left behind by a watcher that didn't exit cleanly
+            os.remove(self.socket_path)
+
+        watcher = self
+
+        class _Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                json.dump(watcher.snapshot(), self.wfile, sort_keys=True)
+                self.wfile.write('\n')
+
+        self._server = SocketServer.ThreadingUnixStreamServer(self.socket_path, _Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        LOG.info("# serving the shelf status on {0}".format(self.socket_path))
+
+    def _watch(self):
+        mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF |
+                pyinotify.IN_MOVE_SELF)
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, default_proc_fun=self._event, timeout=self.interval * 1000)
+
+        unwatched = [book for book in self.books if not self._add_watches(manager, mask, book)]
+        LOG.info("# watching {0} books for changes".format(len(self.books) - len(unwatched)))
+
+        try:
+            while True:
+                if notifier.check_events():
+                    # let the burst of changes finish before looking
+                    time.sleep(SETTLE)
+                    while True:
+                        notifier.read_events()
+                        notifier.process_events()
+                        if not notifier.check_events(timeout=0):
+                            break
+
+                # books that couldn't be watched (missing ones) are looked
+                # at each interval, & watched once they can be
+                for book in list(unwatched):
+                    if self._add_watches(manager, mask, book):
+                        unwatched.remove(book)
+                pending, self._pending = self._pending, set()
+                pending.update(book.path for book in unwatched)
+                if pending:
+                    books = [book for book in self.books if book.path in pending]
+                    self.check(books, force=True)
+                    # a removed book loses its watches, watch for it coming back
+                    for book in books:
+                        if self.results[book.path].state == 'missing' and book not in unwatched:
+                            unwatched.append(book)
+        finally:
+            notifier.stop()
+
+    def _add_watches(self, manager, mask, book):
+        """Watch the files book's status depends on, returns False if it can't be watched yet"""
+        path = os.path.abspath(book.path)
+
+        if book.link is not None:
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                return False
+            if parent not in self._link_parents:
+                manager.add_watch(parent, mask)
+            self._link_parents.setdefault(parent, {})[os.path.basename(path)] = book
+            return True
+
+        gitdir = GitDir(path)
+        if not gitdir.exists():
+            return False
+
+        # the working tree, less .git, which changes whenever git runs
+        wds = manager.add_watch(path, mask, rec=True, auto_add=True,
+                                exclude_filter=lambda name: os.path.basename(name) == '.git' or
+                                '{0}.git{0}'.format(os.sep) in name)
+        # HEAD, the index, FETCH_HEAD & the refs
+        wds.update(manager.add_watch(gitdir.path, mask))
+        for refs in set([os.path.join(gitdir.path, 'refs'), os.path.join(gitdir.common, 'refs')]):
+            if os.path.isdir(refs):
+                wds.update(manager.add_watch(refs, mask, rec=True, auto_add=True))
+        if gitdir.common != gitdir.path:
+            wds.update(manager.add_watch(gitdir.common, mask))
+
+        # events are matched to books by watch, as a moved directory's
+        # events no longer carry its old path
+        for wd in wds.values():
+            if wd >= 0:
+                self._wds[wd] = book
+        self._roots[path] = book
+        return True
+
+    def _event(self, event):
+        """Note the book(s) an inotify event touches"""
+        links = self._link_parents.get(event.path)
+        if links is not None and event.name in links:
+            self._pending.add(links[event.name].path)
+
+        book = self._wds.get(event.wd)
+        if book is not None:
+            self._pending.add(book.path)
+            return
+
+        # directories created since the book was watched have new watches,
+        # find the book by path
+        path = event.path
+        while True:
+            book = self._roots.get(path)
+            if book is not None:
+                self._pending.add(book.path)
+                return
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+            path = parent
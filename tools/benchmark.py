@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Copyright 2012 Hewlett-Packard Development Company, L.P. All Rights Reserved.
+#
+# Author: Simon McCartney <simon.mccartney@hp.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Time gitshelf against synthetic shelves of local repos
+
+Generates a shelf of N books, each cloned from its own bare repo over
+file://, then times install, status (with & without the state file), diff &
+discover against it, for each size asked for.  Every command is run as a
+separate gitshelf process, reporting its wall time, the number of git
+commands it ran (from --profile-trace) & its peak RSS.
+
+    python tools/benchmark.py --books 10,100,1000 --commits 20 --files 50
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# every commit is made with the same identity & dates, so runs are repeatable
+GIT_ENV = {'GIT_AUTHOR_NAME': 'gitshelf benchmark',
+           'GIT_AUTHOR_EMAIL': 'benchmark@gitshelf',
+           'GIT_AUTHOR_DATE': '2012-01-01T00:00:00Z',
+           'GIT_COMMITTER_NAME': 'gitshelf benchmark',
+           'GIT_COMMITTER_EMAIL': 'benchmark@gitshelf',
+           'GIT_COMMITTER_DATE': '2012-01-01T00:00:00Z'}
+
+# one in LINK_EVERY books is a link to the book before it
+LINK_EVERY = 10
+
+
+def git(*args, **kwargs):
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    subprocess.check_call(('git',) + args, env=env, stdout=open(os.devnull, 'w'), **kwargs)
+
+
+def make_template(path, commits, files):
+    """A repo with the given history, that every remote is cloned from"""
+    git('init', '--quiet', path)
+    for commit in range(commits):
+        for index in range(files):
+            with open(os.path.join(path, 'file{0}.txt'.format(index)), 'a') as fh:
+                fh.write('commit {0} of file {1}\n'.format(commit, index))
+        git('add', '--all', cwd=path)
+        git('commit', '--quiet', '--message', 'commit {0}'.format(commit), cwd=path)
+    git('tag', 'v1', cwd=path)
+
+
+def make_shelf(workdir, books, commits, files):
+    """Create books bare remotes & a gitshelf.yml using them, returns the shelf directory"""
+    template = os.path.join(workdir, 'template')
+    remotes = os.path.join(workdir, 'remotes')
+    shelf = os.path.join(workdir, 'shelf')
+    make_template(template, commits, files)
+    os.makedirs(remotes)
+    os.makedirs(shelf)
+
+    with open(os.path.join(shelf, 'gitshelf.yml'), 'w') as fh:
+        fh.write('books:\n')
+        for index in range(books):
+            if index % LINK_EVERY == LINK_EVERY - 1:
+                fh.write('  - book: srv/book{0}\n    link: book{1}\n'.format(index, index - 1))
+                continue
+            remote = os.path.join(remotes, 'book{0}.git'.format(index))
+            git('clone', '--quiet', '--bare', '--no-hardlinks', template, remote)
+            fh.write('  - book: srv/book{0}\n    git: "file://{1}"\n'.format(index, remote))
+            if index % 2:
+                # half the books are pinned to a tag rather than a branch
+                fh.write('    branch: v1\n')
+
+    return shelf
+
+
+def run_gitshelf(args, cwd, trace):
+    """Run gitshelf, returns (seconds, git commands, peak RSS in KiB, exit status)"""
+    command = [sys.executable, '-c', 'from gitshelf.shell import main; main()'] + args
+    if trace is not None:
+        command += ['--profile-trace', trace]
+    env = dict(os.environ)
+    # keep the config cache & state files of each run inside the workdir
+    env['XDG_CACHE_HOME'] = os.path.join(cwd, '.cache')
+
+    started = time.time()
+    process = subprocess.Popen(command, cwd=cwd, env=env,
+                               stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    # wait4 gives the peak RSS of gitshelf & the git commands it waited for
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - started
+    process.returncode = status
+
+    commands = None
+    if trace is not None:
+        with open(trace) as fh:
+            commands = sum(1 for event in json.load(fh)['traceEvents'] if event['cat'] == 'git')
+        os.remove(trace)
+
+    rss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes rather than KiB
+        rss //= 1024
+    return (seconds, commands, rss, os.WEXITSTATUS(status))
+
+
+# (name, gitshelf arguments, directory to run in) for each operation timed,
+# in the order they're run
+OPERATIONS = (('install', ['install'], 'shelf'),
+              ('status', ['status'], 'shelf'),
+              ('status-state-cold', ['status', '--state'], 'shelf'),
+              ('status-state-warm', ['status', '--state'], 'shelf'),
+              ('diff', ['diff'], 'shelf'),
+              ('discover', ['discover', '--output', os.devnull], 'srv'))
+
+
+def benchmark(books, args):
+    workdir = tempfile.mkdtemp(prefix='gitshelf-bench-{0}-'.format(books), dir=args.workdir)
+    try:
+        started = time.time()
+        shelf = make_shelf(workdir, books, args.commits, args.files)
+        sys.stderr.write('# {0} books generated in {1:.1f}s\n'.format(books, time.time() - started))
+
+        results = []
+        for name, gitshelf_args, where in OPERATIONS:
+            cwd = shelf if where == 'shelf' else os.path.join(shelf, 'srv')
+            gitshelf_args = gitshelf_args + ['--jobs', str(args.jobs)]
+            trace = os.path.join(workdir, 'trace.json')
+            seconds, commands, rss, status = run_gitshelf(gitshelf_args, cwd, trace)
+            results.append({'books': books,
+                            'operation': name,
+                            'seconds': round(seconds, 3),
+                            'git_commands': commands,
+                            'peak_rss_kib': rss,
+                            'exit_status': status})
+            sys.stderr.write('# {0} books, {1}: {2:.3f}s\n'.format(books, name, seconds))
+        return results
+    finally:
+        if args.keep:
+            sys.stderr.write('# kept {0}\n'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time gitshelf against synthetic shelves of local repos')
+    parser.add_argument('--books', default='10,100,1000',
+                        help='comma separated shelf sizes to benchmark, defaults to 10,100,1000')
+    parser.add_argument('--commits', type=int, default=10, help='commits in each repo, defaults to 10')
+    parser.add_argument('--files', type=int, default=20, help='files in each repo, defaults to 20')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='gitshelf --jobs, defaults to 1')
+    parser.add_argument('--workdir', default=None,
+                        help='where to generate the shelves, defaults to the system temp directory')
+    parser.add_argument('--keep', action='store_true', help="don't delete the generated shelves")
+    parser.add_argument('--json', dest='json_file', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for books in [int(size) for size in args.books.split(',')]:
+        results += benchmark(books, args)
+
+    print('{0:>6}  {1:<18} {2:>9} {3:>8} {4:>10} {5:>4}'.format(
+        'books', 'operation', 'seconds', 'git', 'rss (KiB)', 'exit'))
+    for result in results:
+        print('{books:>6}  {operation:<18} {seconds:>9.3f} {git:>8} {peak_rss_kib:>10} {exit_status:>4}'.format(
+            git='-' if result['git_commands'] is None else result['git_commands'], **result))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True, separators=(',', ': '))
+            fh.write('\n')
+
+
+if __name__ == '__main__':
+    main()